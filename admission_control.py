@@ -0,0 +1,304 @@
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import List, Dict, Any
+
+
+logging.basicConfig(
+    format="%(name)s - %(asctime)s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("Admission Control")
+
+# lower number is admitted first
+PRIORITIES = {'interactive': 0, 'bulk': 1}
+
+# advisory lock class of the database wide bulk slots, see acquire_bulk_slot()
+BULK_SLOT_LOCK_CLASS = 7301
+
+
+class AdmissionRejected(Exception):
+
+    '''
+    Raised instead of queueing when a request cannot be admitted
+    status is one of 'queue_full', 'rate_limited' or 'timeout'
+    '''
+
+    def __init__(self, status : str, department : str, priority : str):
+        super(AdmissionRejected, self).__init__(f'{status}: request from {department} ({priority}) not admitted')
+        self.status = status
+        self.department = department
+        self.priority = priority
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate : float, burst : float):
+
+        '''
+        Inputs: rate - tokens added per second
+                burst - most tokens the bucket holds
+        '''
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> bool:
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class AdmissionController(object):
+
+    # --------------
+    # Admission control
+    # --------------
+
+    # Every service call that touches the database first asks for a slot with admit().
+    # At most max_concurrent calls hold a slot at once, and each department can be given its own
+    # concurrency limit and token bucket. Calls waiting for a slot are admitted in priority order
+    # (interactive before bulk, then first come first served), skipping any whose department is at
+    # its limit. Waiting is bounded: a full queue or a department over its rate fails straight away,
+    # and a call that waits longer than queue_timeout_seconds gives up, all with AdmissionRejected.
+
+    ADMISSION_METRICS_LOG = "logs/admission_metrics_log.json"
+
+    def __init__(self, max_concurrent : int = 8, max_queue : int = 64, queue_timeout_seconds : float = 2,
+                 department_limits : Dict[str, Dict[str, float]] = None):
+
+        '''
+        Inputs: max_concurrent - calls allowed to use the database at once
+                max_queue - calls allowed to wait, per priority class
+                queue_timeout_seconds - longest a call waits for a slot
+                department_limits - optional per department limits, e.g.
+                    {'welfare_dept': {'max_concurrent': 4, 'rate': 50, 'burst': 100}}
+        '''
+
+        self.logger = logging.getLogger('Admission Control')
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.department_limits = department_limits or {}
+
+        self.buckets = {department: TokenBucket(limits['rate'], limits.get('burst', limits['rate']))
+                        for department, limits in self.department_limits.items() if 'rate' in limits}
+
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.arrivals = 0
+        self.in_flight = 0
+        self.in_flight_by_department = {}
+
+        self.admitted = {priority: 0 for priority in PRIORITIES}
+        self.rejected = {'queue_full': 0, 'rate_limited': 0, 'timeout': 0}
+        self.wait_seconds = {priority: {'count': 0, 'total': 0.0, 'max': 0.0} for priority in PRIORITIES}
+
+    def _has_capacity(self, department : str) -> bool:
+
+        if self.in_flight >= self.max_concurrent:
+            return False
+
+        limit = self.department_limits.get(department, {}).get('max_concurrent')
+
+        return limit is None or self.in_flight_by_department.get(department, 0) < limit
+
+    def _dispatch(self) -> None:
+
+        # grant slots to waiters in (priority, arrival) order while there is capacity
+        for waiter in sorted(self.waiting, key=lambda waiter: waiter['order']):
+            if self.in_flight >= self.max_concurrent:
+                break
+            if self._has_capacity(waiter['department']):
+                self._grant(waiter['department'])
+                waiter['granted'] = True
+                self.waiting.remove(waiter)
+
+        self.condition.notify_all()
+
+    def _grant(self, department : str) -> None:
+
+        self.in_flight += 1
+        self.in_flight_by_department[department] = self.in_flight_by_department.get(department, 0) + 1
+
+    def _record_wait(self, priority : str, waited : float) -> None:
+
+        stats = self.wait_seconds[priority]
+        stats['count'] += 1
+        stats['total'] += waited
+        stats['max'] = max(stats['max'], waited)
+        self.admitted[priority] += 1
+
+    def _reject(self, status : str, department : str, priority : str) -> None:
+
+        self.rejected[status] += 1
+        logger.info(f"rejected request from {department} ({priority}): {status}")
+
+        raise AdmissionRejected(status, department, priority)
+
+    def acquire(self, department : str, priority : str = 'interactive') -> None:
+
+        """
+        Method to wait for a slot, see admit()
+        """
+
+        if priority not in PRIORITIES:
+            raise ValueError(f'priority must be one of {list(PRIORITIES)}')
+
+        started = time.monotonic()
+
+        with self.condition:
+            bucket = self.buckets.get(department)
+            if bucket is not None and not bucket.take():
+                self._reject('rate_limited', department, priority)
+
+            queued = [waiter for waiter in self.waiting if waiter['priority'] == priority]
+            has_priority = not any(PRIORITIES[waiter['priority']] <= PRIORITIES[priority] for waiter in self.waiting)
+
+            # admit straight away if nothing of equal or higher priority is waiting ahead of us
+            if has_priority and self._has_capacity(department):
+                self._grant(department)
+                self._record_wait(priority, 0.0)
+                return
+
+            if len(queued) >= self.max_queue:
+                self._reject('queue_full', department, priority)
+
+            self.arrivals += 1
+            waiter = {'order': (PRIORITIES[priority], self.arrivals),
+                      'priority': priority,
+                      'department': department,
+                      'granted': False}
+            self.waiting.append(waiter)
+            self._dispatch()
+
+            deadline = started + self.queue_timeout_seconds
+
+            while not waiter['granted']:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.waiting.remove(waiter)
+                    self._reject('timeout', department, priority)
+                self.condition.wait(remaining)
+
+            self._record_wait(priority, time.monotonic() - started)
+
+        return
+
+    def release(self, department : str) -> None:
+
+        with self.condition:
+            self.in_flight -= 1
+            self.in_flight_by_department[department] -= 1
+            self._dispatch()
+
+        return
+
+    @contextmanager
+    def admit(self, department : str, priority : str = 'interactive'):
+
+        """
+        Context manager holding a slot for the duration of the block
+        Inputs: department - department the call is made for or by
+                priority - 'interactive' or 'bulk'
+        Raises AdmissionRejected if the call is not admitted.
+        e.g. with admission.admit('welfare_dept', 'interactive'):
+                 ...
+        """
+
+        self.acquire(department, priority)
+
+        try:
+            yield
+        finally:
+            self.release(department)
+
+    def metrics(self) -> Dict[str, Any]:
+
+        """
+        Method to get queue depth, in flight, admitted, rejected and wait time figures
+        """
+
+        with self.condition:
+            queue_depth = {priority: 0 for priority in PRIORITIES}
+            for waiter in self.waiting:
+                queue_depth[waiter['priority']] += 1
+
+            wait_seconds = {}
+            for priority, stats in self.wait_seconds.items():
+                wait_seconds[priority] = {'count': stats['count'],
+                                          'mean': stats['total'] / stats['count'] if stats['count'] else 0.0,
+                                          'max': stats['max']}
+
+            return {'queue_depth': queue_depth,
+                    'in_flight': self.in_flight,
+                    'in_flight_by_department': dict(self.in_flight_by_department),
+                    'admitted': dict(self.admitted),
+                    'rejected': dict(self.rejected),
+                    'wait_seconds': wait_seconds}
+
+    def log_metrics(self) -> Dict[str, Any]:
+
+        """
+        Method to append the current metrics to ADMISSION_METRICS_LOG
+        """
+
+        metrics_log = self.metrics()
+        metrics_log['logged_at'] = datetime.datetime.now()
+
+        with open(self.ADMISSION_METRICS_LOG, mode="a+", encoding="utf-8") as f:
+            f.write(f"{metrics_log} \r\n")
+
+        return metrics_log
+
+
+def admitted(admission : AdmissionController, department : str, priority : str = 'interactive'):
+
+    """
+    Context manager used by the service clients: admission.admit(), or nothing if admission is None
+    """
+
+    if admission is None:
+        return nullcontext()
+
+    return admission.admit(department, priority)
+
+
+def acquire_bulk_slot(db, slots : int, timeout_seconds : float = None, poll_seconds : float = 0.05) -> int:
+
+    """
+    Method to wait for one of slots bulk slots shared by every process using the database
+    An AdmissionController only sees its own process, this bounds bulk work such as bulk_ingest.py
+    workers across processes. A slot is a transaction level advisory lock, so it must be called
+    inside db.transaction() and is released when that transaction commits or rolls back.
+    Inputs: db - DatabaseQueries with a transaction open
+            slots - number of bulk transactions allowed at once
+            timeout_seconds - longest to wait for a slot, None to wait until one is free
+    Output: the slot taken
+    Raises AdmissionRejected with status 'timeout' if no slot is free within timeout_seconds.
+    """
+
+    started = time.monotonic()
+
+    while True:
+        for slot in range(slots):
+            if db.try_advisory_xact_lock(BULK_SLOT_LOCK_CLASS, slot):
+                return slot
+
+        if timeout_seconds is not None and time.monotonic() - started >= timeout_seconds:
+            logger.info(f"no bulk slot of {slots} free within {timeout_seconds}s")
+            raise AdmissionRejected('timeout', 'bulk_ingest', 'bulk')
+
+        time.sleep(poll_seconds)
@@ -0,0 +1,442 @@
+import json
+import logging
+import argparse
+import datetime
+import multiprocessing
+from contextlib import ExitStack
+from queue import Empty, Full
+from jsonschema.validators import validator_for
+from typing import List, Dict, Any, Iterator
+from database_operations import DatabaseQueries
+from pseudonyms import Pseudonymiser
+from registration import Registration
+from admission_control import AdmissionRejected, acquire_bulk_slot
+
+
+logging.basicConfig(
+    format="%(name)s - %(asctime)s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("Bulk Ingest")
+
+# schema each kind of input is validated against before it is inserted
+SCHEMAS = {'registration': "json_validators/register_input_to_id_table.json",
+           'health': "json_validators/health_table_input.json"}
+
+
+def _ingest_worker(kind : str, shard : int, bulk_slots : int, bulk_slot_timeout : float, chunk_queue, result_queue) -> None:
+
+    '''
+    Worker process: pulls chunks of records for its shard, validates and batch inserts them
+    Every worker holds its own database connection and compiled validator.
+    Each batch transaction first waits up to bulk_slot_timeout seconds for one of bulk_slots database
+    wide bulk slots (None for no limit), if none is free the batch fails and is reported as such.
+    Messages sent back on result_queue:
+        ('progress', shard, n_inserted, n_failed)
+        ('failure', shard, record, reason)
+        ('registered', shard, record, {department: token}), once the record's batch has committed
+        ('done', shard, None, None)
+    '''
+
+    db = DatabaseQueries()
+
+    with open(SCHEMAS[kind], 'r') as f:
+        schema = json.load(f)
+
+    validator = validator_for(schema)(schema)
+
+    pseudonymiser = Pseudonymiser()
+
+    while True:
+        chunk = chunk_queue.get()
+
+        # None is the coordinator telling us there is no more input
+        if chunk is None:
+            break
+
+        valid = []
+        seen = set()
+        for record in chunk:
+            if kind == 'registration':
+                # the registration schema expects the logged_at field added by registration_insert_record
+                record = dict(record, logged_at=str(datetime.datetime.now()))
+
+            error = next(validator.iter_errors(record), None)
+
+            if error is not None:
+                result_queue.put(('failure', shard, record, f'invalid input: {error.message}'))
+            elif record['id'] in seen:
+                result_queue.put(('failure', shard, record, 'id appears more than once in input'))
+            else:
+                seen.add(record['id'])
+                valid.append(record)
+
+        ids = [record['id'] for record in valid]
+        issued = {}
+
+        try:
+            # the batch, and for registrations its tokens, commit together or not at all
+            with db.transaction():
+                if bulk_slots is not None:
+                    acquire_bulk_slot(db, bulk_slots, bulk_slot_timeout)
+
+                if kind == 'registration':
+                    in_use = set(db.ids_in_table('id_register', ids))
+                    to_insert = [record for record in valid if record['id'] not in in_use]
+
+                    for record in valid:
+                        if record['id'] in in_use:
+                            result_queue.put(('failure', shard, record, 'id is already in use'))
+
+                    if to_insert:
+                        db.register_insert_records_batch(to_insert)
+                        token_rows = pseudonymiser.token_rows([record['id'] for record in to_insert])
+                        db.insert_id_tokens(token_rows)
+
+                        for department, key_version, token, id in token_rows:
+                            issued.setdefault(id, {})[department] = token
+
+                else:
+                    registered = set(db.ids_in_table('id_register', ids))
+                    existing = set(db.ids_in_table('health_table', ids))
+                    to_insert = []
+
+                    for record in valid:
+                        if record['id'] not in registered:
+                            result_queue.put(('failure', shard, record, 'id is not registered in id_register table'))
+                        elif record['id'] in existing:
+                            result_queue.put(('failure', shard, record, 'duplicate found in health table'))
+                        else:
+                            to_insert.append(record)
+
+                    if to_insert:
+                        db.insert_health_records_batch(to_insert)
+
+        except Exception as e:
+            if isinstance(e, AdmissionRejected):
+                reason = f'batch not inserted: no bulk slot free within {bulk_slot_timeout}s'
+            else:
+                reason = f'batch insert failed: {e}'
+
+            # the batch's transaction has been rolled back, report every record in it
+            for record in valid:
+                result_queue.put(('failure', shard, record, reason))
+            to_insert = []
+            issued = {}
+
+        # only reported once committed, the tokens are all a department gets for a bulk registered id
+        for record in to_insert:
+            if record['id'] in issued:
+                result_queue.put(('registered', shard, record, issued[record['id']]))
+
+        result_queue.put(('progress', shard, len(to_insert), len(chunk) - len(to_insert)))
+
+    result_queue.put(('done', shard, None, None))
+
+    return
+
+
+class BulkIngest(object):
+
+    BULK_INGEST_LOG = "logs/bulk_ingest_log.json"
+
+    # records per chunk handed to a worker, and chunks allowed in flight per worker
+    CHUNK_SIZE = 1000
+    IN_FLIGHT_CHUNKS = 4
+
+    # how long a put waits on a full worker queue before checking the worker is still alive
+    PUT_TIMEOUT_SECONDS = 1
+
+    # how long a batch waits for a bulk slot before it is failed, when bulk_slots is set
+    BULK_SLOT_TIMEOUT_SECONDS = 30
+
+    def __init__(self, kind : str, workers : int = None, partition : str = 'hash', bulk_slots : int = None,
+                 tokens_path : str = None):
+
+        '''
+        Inputs: kind - 'registration' or 'health'
+                workers - number of worker processes, defaults to the number of cores
+                partition - 'hash' (id modulo workers) or 'range' (contiguous blocks of the id space)
+                bulk_slots - batch transactions allowed at once across every bulk job using the
+                database (see acquire_bulk_slot in admission_control.py), None (default) for no limit.
+                A batch that waits BULK_SLOT_TIMEOUT_SECONDS without a slot is failed.
+                tokens_path - for registrations, file the issued tokens are written to, one
+                {"id": ..., "tokens": {department: token}} per line, to be handed to each department
+        '''
+
+        if kind not in SCHEMAS:
+            raise ValueError(f'kind must be one of {list(SCHEMAS)}')
+        if partition not in ('hash', 'range'):
+            raise ValueError("partition must be 'hash' or 'range'")
+        if kind == 'registration' and tokens_path is None:
+            raise ValueError('tokens_path is needed for registrations, the issued tokens are written to it')
+
+        self.logger = logging.getLogger('Bulk Ingest')
+        self.kind = kind
+        self.workers = workers or multiprocessing.cpu_count()
+        self.partition = partition
+        self.bulk_slots = bulk_slots
+        self.tokens_path = tokens_path
+
+    def shard_for(self, id : int) -> int:
+
+        # the same id always lands on the same worker, so workers never race on an id
+
+        if self.partition == 'hash':
+            return hash(id) % self.workers
+
+        return min(id * self.workers // Registration.SIZE_OF_ID_SPACE, self.workers - 1)
+
+    def _handle_result(self, message, state : Dict[str, Any]) -> None:
+
+        kind, shard, a, b = message
+        totals = state['totals']
+
+        if kind == 'progress':
+            totals['inserted'] += a
+            totals['failed'] += b
+            logger.info(f"shard {shard}: {totals['inserted']} inserted, {totals['failed']} failed so far")
+
+        elif kind == 'failure':
+            self._log_failure(state, shard, a, b)
+
+        elif kind == 'registered':
+            self._log_registration(state, a, b)
+
+        elif kind == 'done':
+            state['done_shards'].add(shard)
+
+        return
+
+    def _log_failure(self, state : Dict[str, Any], shard : int, record, reason : str) -> None:
+
+        record_log = {'shard': shard,
+                      'record': record,
+                      'reason': reason,
+                      'logged_at': datetime.datetime.now()}
+        state['failure_log'].write(f"{record_log} \r\n")
+
+        return
+
+    def _log_registration(self, state : Dict[str, Any], record : Dict, tokens : Dict[str, str]) -> None:
+
+        # same log entry as Registration.registration_insert_record, the tokens go to tokens_path only
+        registration_insert_log = {'name': record['name'],
+                                   'id': record['id'],
+                                   'logged_at': datetime.datetime.now(),
+                                   'successful': True}
+        state['registration_log'].write(f"{registration_insert_log} \r\n")
+
+        state['tokens_file'].write(json.dumps({'id': record['id'], 'tokens': tokens}) + '\n')
+
+        return
+
+    def _drain(self, state : Dict[str, Any], block : bool = False) -> None:
+
+        while True:
+            try:
+                message = state['result_queue'].get(block=block, timeout=1 if block else None)
+            except Empty:
+                return
+            self._handle_result(message, state)
+            if block:
+                return
+
+    def _worker_died(self, state : Dict[str, Any], shard : int) -> bool:
+
+        if shard in state['dead']:
+            return True
+
+        if shard not in state['done_shards'] and not state['processes'][shard].is_alive():
+            # its done message may still be in the result queue
+            self._drain(state)
+
+        if shard not in state['done_shards'] and not state['processes'][shard].is_alive():
+            logger.info(f"worker for shard {shard} exited without finishing")
+            state['dead'].add(shard)
+            return True
+
+        return False
+
+    def _put(self, state : Dict[str, Any], shard : int, item) -> bool:
+
+        '''
+        Put a chunk (or the None sentinel) on a worker's queue, waiting while the queue is full
+        Output: False if the worker has died, in which case the item was not queued
+        '''
+
+        while not self._worker_died(state, shard):
+            try:
+                state['chunk_queues'][shard].put(item, timeout=self.PUT_TIMEOUT_SECONDS)
+                return True
+            except Full:
+                # keep reading results while we wait so workers never block on the result queue
+                self._drain(state)
+
+        return False
+
+    def _dispatch(self, state : Dict[str, Any], shard : int, chunk : List[Dict]) -> None:
+
+        if not self._put(state, shard, chunk):
+            for record in chunk:
+                self._log_failure(state, shard, record, f'worker for shard {shard} exited')
+            state['totals']['failed'] += len(chunk)
+
+        self._drain(state)
+
+        return
+
+    def run(self, records : Iterator[Dict]) -> Dict[str, int]:
+
+        '''
+        Method to ingest an iterable of records across the worker pool
+        Input is consumed lazily: each worker has a bounded queue of chunks, so once a
+        worker is IN_FLIGHT_CHUNKS behind the coordinator blocks instead of buffering.
+        A worker that dies is fatal for its shard: records routed to it afterwards are logged
+        as failed, chunks already queued to it are unaccounted for, and the run is reported aborted.
+        Output: counts of inserted and failed records, and whether the run was aborted
+        '''
+
+        chunk_queues = [multiprocessing.Queue(maxsize=self.IN_FLIGHT_CHUNKS) for _ in range(self.workers)]
+        result_queue = multiprocessing.Queue()
+
+        processes = [multiprocessing.Process(target=_ingest_worker, args=(self.kind, shard, self.bulk_slots, self.BULK_SLOT_TIMEOUT_SECONDS, chunk_queues[shard], result_queue))
+                     for shard in range(self.workers)]
+
+        for p in processes:
+            p.start()
+
+        pending = [[] for _ in range(self.workers)]
+
+        started_at = datetime.datetime.now()
+
+        with ExitStack() as files:
+
+            failure_log = files.enter_context(open(self.BULK_INGEST_LOG, mode="a+", encoding="utf-8"))
+
+            registration_log = None
+            tokens_file = None
+            if self.kind == 'registration':
+                registration_log = files.enter_context(open(Registration.REGISTRATION_RECORD_LOG, mode="a+", encoding="utf-8"))
+                tokens_file = files.enter_context(open(self.tokens_path, mode="a", encoding="utf-8"))
+
+            state = {'totals': {'inserted': 0, 'failed': 0},
+                     'failure_log': failure_log,
+                     'registration_log': registration_log,
+                     'tokens_file': tokens_file,
+                     'result_queue': result_queue,
+                     'chunk_queues': chunk_queues,
+                     'processes': processes,
+                     'done_shards': set(),
+                     'dead': set()}
+
+            try:
+                for record in records:
+                    # records without a usable id cannot be routed, they fail here instead of in a worker
+                    try:
+                        shard = self.shard_for(record['id'])
+                    except (KeyError, TypeError, ValueError) as e:
+                        self._log_failure(state, None, record, f'cannot route record: {e!r}')
+                        state['totals']['failed'] += 1
+                        continue
+
+                    pending[shard].append(record)
+
+                    if len(pending[shard]) >= self.CHUNK_SIZE:
+                        self._dispatch(state, shard, pending[shard])
+                        pending[shard] = []
+
+                for shard in range(self.workers):
+                    if pending[shard]:
+                        self._dispatch(state, shard, pending[shard])
+                        pending[shard] = []
+
+            finally:
+                # every worker gets its sentinel, even if reading the input failed
+                for shard in range(self.workers):
+                    self._put(state, shard, None)
+
+            aborted = False
+
+            while len(state['done_shards']) < self.workers:
+                self._drain(state, block=True)
+
+                if any(self._worker_died(state, shard) for shard in range(self.workers)):
+                    # pick up anything the dead worker sent before it exited, then give up
+                    self._drain(state)
+                    logger.info(f"aborting bulk ingest, workers for shards {sorted(state['dead'])} died")
+                    aborted = True
+                    for p in processes:
+                        if p.is_alive():
+                            p.terminate()
+                    break
+
+            for p in processes:
+                p.join()
+
+            totals = state['totals']
+
+            ingest_log = {"kind": self.kind,
+                          "workers": self.workers,
+                          "partition": self.partition,
+                          "bulk_slots": self.bulk_slots,
+                          "inserted": totals['inserted'],
+                          "failed": totals['failed'],
+                          "aborted": aborted,
+                          "started_at": started_at,
+                          "finished_at": datetime.datetime.now()}
+
+            logger.info(f"bulk ingest finished: {ingest_log}")
+
+            failure_log.write(f"{ingest_log} \r\n")
+
+        return {'inserted': totals['inserted'], 'failed': totals['failed'], 'aborted': aborted}
+
+
+def read_records(path : str) -> Iterator[Dict]:
+
+    '''
+    Generator over a file of one JSON record per line
+    '''
+
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--kind',
+            dest='kind',
+            help="'registration' or 'health'")
+    parser.add_argument('-f', '--file',
+            dest='file',
+            help='file with one JSON record per line')
+    parser.add_argument('-w', '--workers',
+            dest='workers',
+            type=int,
+            default=None,
+            help='number of worker processes, defaults to number of cores')
+    parser.add_argument('-pt', '--partition',
+            dest='partition',
+            default='hash',
+            help="'hash' or 'range'")
+    parser.add_argument('-t', '--tokens',
+            dest='tokens',
+            default=None,
+            help='for registrations, file to write the issued department tokens to')
+    parser.add_argument('-s', '--bulk_slots',
+            dest='bulk_slots',
+            type=int,
+            default=0,
+            help='batch transactions allowed at once across all bulk jobs, 0 (default) for no limit')
+
+    args = parser.parse_args()
+
+    b = BulkIngest(args.kind, args.workers, args.partition, args.bulk_slots or None, args.tokens)
+
+    print(b.run(read_records(args.file)))
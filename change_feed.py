@@ -0,0 +1,127 @@
+import time
+import logging
+import argparse
+from typing import List, Dict, Any, Callable
+from database_operations import DatabaseQueries
+
+
+logging.basicConfig(
+    format="%(name)s - %(asctime)s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("Change Feed")
+
+class ChangeFeedConsumer(DatabaseQueries):
+
+    # --------------
+    # Change feed
+    # --------------
+
+    # Triggers on health_table and id_register write one change_log row per inserted or updated row,
+    # in the same transaction as the write (see db_tables.sql).
+    # A consumer reads changes in (txid, seq) order from its last acknowledged position and
+    # acknowledges once it has processed them. Only changes from finished transactions are read,
+    # so a consumer never skips a change that commits after it has moved past it.
+    # Delivery is at least once: if the consumer stops between processing and ack it sees the batch again.
+
+    DEFAULT_BATCH_SIZE = 1000
+    POLL_INTERVAL_SECONDS = 1
+
+    def __init__(self, consumer : str):
+        self.logger = logging.getLogger('Change Feed')
+        self.consumer = consumer
+        self.db = DatabaseQueries()
+
+    def poll(self, batch_size : int = None) -> List[Dict[str, Any]]:
+
+        """
+        Method to read the next batch of changes after this consumer's acknowledged position
+        Output: list of changes, each {'seq', 'txid', 'table_name', 'row_id', 'operation', 'changed_at'}
+        """
+
+        if batch_size is None:
+            batch_size = self.DEFAULT_BATCH_SIZE
+
+        acked_txid, acked_seq = self.db.change_log_position(self.consumer)
+
+        return self.db.change_log_batch(acked_txid, acked_seq, batch_size).to_dict('records')
+
+    def ack(self, change : Dict[str, Any]) -> None:
+
+        """
+        Method to acknowledge every change up to and including the given one
+        """
+
+        self.db.ack_change_log(self.consumer, change['txid'], change['seq'])
+
+        return
+
+    def tail(self, handler : Callable[[List[Dict[str, Any]]], None], batch_size : int = None, max_batches : int = None) -> int:
+
+        """
+        Method to follow the change feed, calling handler with each batch and acknowledging it after
+        Inputs: handler - called with a list of changes, raising stops the tail without acknowledging
+                batch_size - maximum changes per batch
+                max_batches - stop after this many batches, None to follow forever
+        Output: number of changes handled
+        """
+
+        handled = 0
+        batches = 0
+
+        while max_batches is None or batches < max_batches:
+            changes = self.poll(batch_size)
+
+            if not changes:
+                time.sleep(self.POLL_INTERVAL_SECONDS)
+                continue
+
+            handler(changes)
+            self.ack(changes[-1])
+
+            handled += len(changes)
+            batches += 1
+
+            logger.info(f"{self.consumer} handled {handled} changes, last seq {changes[-1]['seq']}")
+
+        return handled
+
+    def prune(self) -> int:
+
+        """
+        Method to delete changes that every consumer has acknowledged
+        """
+
+        deleted = self.db.prune_change_log()
+
+        logger.info(f"pruned {deleted} changes acknowledged by every consumer")
+
+        return deleted
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--consumer',
+            dest='consumer',
+            help='name of consumer, its position is kept in change_log_consumers')
+    parser.add_argument('-b', '--batch_size',
+            dest='batch_size',
+            type=int,
+            default=None,
+            help='maximum changes per batch')
+    parser.add_argument('-pr', '--prune',
+            dest='prune',
+            default=False,
+            help='Set to true to delete changes acknowledged by every consumer')
+
+    args = parser.parse_args()
+
+    c = ChangeFeedConsumer(args.consumer)
+
+    if args.prune:
+        c.prune()
+    else:
+        c.tail(lambda changes: [print(change) for change in changes], args.batch_size)
@@ -4,6 +4,7 @@ import json
 import records
 import psycopg2
 import logging
+import re
 import datetime
 import psycopg2.extras
 from jsonschema import validate
@@ -14,6 +15,12 @@ logging.basicConfig(format='%(name)s - %(asctime)s - %(message)s',
         datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 logger = logging.getLogger('database operations')
 
+# a department token is a hex HMAC-SHA256 digest, see pseudonyms.py
+TOKEN_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+def is_valid_token(token) -> bool:
+    return isinstance(token, str) and TOKEN_PATTERN.fullmatch(token) is not None
+
 class DatabaseQueries(DatabaseInitialLogin):
 
     def __init__(self):
@@ -45,12 +52,10 @@ class DatabaseQueries(DatabaseInitialLogin):
         for key in keys:
             insert_tuple += (record[key],)
 
-        now = str(datetime.datetime.now())
-        insert_tuple += (now,)
-
+        # record_created_at and record_updated_at are set by the database
         query = f'''
         INSERT INTO health_table
-            (id, registered_doctor, has_asthma, has_registered_disability, record_updated_at)
+            (id, registered_doctor, has_asthma, has_registered_disability)
         VALUES
             {insert_tuple}
         '''
@@ -79,15 +84,18 @@ class DatabaseQueries(DatabaseInitialLogin):
         logger.info(f'Health table update input passed validation')
 
         # this is ugly, have to be careful with quotes when have string or bool in f-string
+        set_update = ''
+
         if record_to_update['registered_doctor'] is not None:
-            set_update = f"registered_doctor = '{record_to_update['registered_doctor']}', "
+            set_update += f"registered_doctor = '{record_to_update['registered_doctor']}', "
 
         if record_to_update['has_asthma'] is not None:
             set_update += f"has_asthma = {record_to_update['has_asthma']}, "
         if record_to_update['has_registered_disability'] is not None:
             set_update += f"has_registered_disability = {record_to_update['has_registered_disability']}, "
 
-        set_update = set_update + f"record_updated_at = '{datetime.datetime.now()}'"
+        # record_updated_at is set by the health_table_record_updated_at trigger
+        set_update = set_update.rstrip(', ')
 
         query = f'''UPDATE health_table SET {set_update} WHERE id = {id_to_update};
                 '''
@@ -111,7 +119,7 @@ class DatabaseQueries(DatabaseInitialLogin):
 
         query = f'''SELECT COUNT(*) FROM health_table WHERE id = {id};'''
 
-        if self.send_query(query).export('df')['count'].to_list()[0] > 0:
+        if self.send_read_query(query).export('df')['count'].to_list()[0] > 0:
             id_exists = True
         else:
             id_exists = False
@@ -120,7 +128,7 @@ class DatabaseQueries(DatabaseInitialLogin):
 
     def query_health_table(self, query):
 
-        return self.send_query(query).export('df')
+        return self.send_read_query(query).export('df')
 
     def is_id_in_use(self, id_to_check):
 
@@ -128,7 +136,7 @@ class DatabaseQueries(DatabaseInitialLogin):
         query = f'''SELECT CAST(CASE WHEN COUNT(*) > 0 THEN 1 ELSE 0 END AS BIT)
                     FROM id_register WHERE id = {id_to_check};'''
 
-        if self.send_query(query).export('df')['bit'].to_list()[0] == '1':
+        if self.send_read_query(query).export('df')['bit'].to_list()[0] == '1':
             id_in_use = True
         else:
             id_in_use = False
@@ -175,7 +183,7 @@ class DatabaseQueries(DatabaseInitialLogin):
         # check name is in db
         query_name = f"SELECT COUNT(*) FROM health_dept_access WHERE name = '{name_wanting_access}' "
 
-        name_in_db = self.send_query(query_name).export('df')['count'].to_list()[0]
+        name_in_db = self.send_read_query(query_name).export('df')['count'].to_list()[0]
 
         if not name_in_db:
             logger.info(f'{name_wanting_access} is not registered as having autthorise access to this db')
@@ -185,7 +193,7 @@ class DatabaseQueries(DatabaseInitialLogin):
 
         query_password = f"SELECT password FROM health_dept_access WHERE name = '{name_wanting_access}'"
 
-        password_in_db = self.send_query(query_password).export('df')['password'].to_list()[0]
+        password_in_db = self.send_read_query(query_password).export('df')['password'].to_list()[0]
 
         if password_in_db == password:
             access_granted = True
@@ -194,3 +202,376 @@ class DatabaseQueries(DatabaseInitialLogin):
             access_granted = False
 
         return access_granted
+
+    def insert_id_tokens(self, token_rows : List[tuple]) -> None:
+
+        '''
+        Method to batch insert pseudonymous tokens into the id_tokens table
+        Inputs: a list of (department, key_version, token, id) tuples
+        Note: rows that already exist are skipped, so a backfill can be safely rerun.
+        '''
+
+        query = '''
+        INSERT INTO id_tokens
+            (department, key_version, token, id)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        '''
+        self.execute_values(query, token_rows)
+
+        return
+
+    def resolve_id_token(self, department : str, token : str) -> int:
+
+        '''
+        Method to map a department's pseudonymous token back to an id_register id
+        Inputs: department - name of department the token was issued to
+                token - the pseudonymous token
+        Output: the id, or None if the token is unknown to that department
+        Note: lookup is on the (department, token) primary key index.
+        '''
+
+        if not is_valid_token(token):
+            logger.info(f'token is not a valid token, not querying')
+            return None
+
+        query = f"SELECT id FROM id_tokens WHERE department = '{department}' AND token = '{token}'"
+
+        # an empty result exports as a dataframe with no columns, so read the rows instead
+        ids = [row.id for row in self.send_read_query(query).all()]
+
+        if ids:
+            return ids[0]
+
+        return None
+
+    def count_ids_without_token(self, department : str, key_version : int) -> int:
+
+        '''
+        Method to count the ids in id_register with no token of a key version for a department
+        Note: uses the (department, key_version, id) unique index on id_tokens.
+        '''
+
+        query = f'''SELECT COUNT(*) FROM id_register r
+                    WHERE NOT EXISTS (SELECT 1 FROM id_tokens t
+                                      WHERE t.department = '{department}'
+                                        AND t.key_version = {key_version}
+                                        AND t.id = r.id);'''
+
+        return self.send_query(query).export('df')['count'].to_list()[0]
+
+    def token_ids_after(self, department : str, key_version : int, last_id : int, batch_size : int) -> List[int]:
+
+        '''
+        Method to page through the ids holding a token of a key version, in id order
+        Output: list of ids, empty once there are no more
+        '''
+
+        query = f'''SELECT id FROM id_tokens
+                    WHERE department = '{department}' AND key_version = {key_version} AND id > {last_id}
+                    ORDER BY id LIMIT {batch_size};'''
+
+        return [row.id for row in self.send_query(query).all()]
+
+    def reissue_tokens(self, department : str, to_version : int, ids : List[int] = None, tokens : List[str] = None) -> List[tuple]:
+
+        '''
+        Method to map a department's tokens of older key versions to its tokens of to_version
+        Every token mapped is marked reissued_at, retire() will not delete tokens that are not.
+        Inputs: department, to_version - the tokens to map to
+                ids or tokens - which old tokens to map, by id or by the token itself
+        Output: list of (old_token, new_token), tokens with no to_version token are left out
+        '''
+
+        if not ids and not tokens:
+            return []
+
+        if ids is not None:
+            selected = f"o.id IN ({', '.join(str(id) for id in ids)})"
+        else:
+            selected = f"o.token IN ({', '.join(repr(token) for token in tokens)})"
+
+        query = f'''UPDATE id_tokens o SET reissued_at = now()
+                    FROM id_tokens n
+                    WHERE o.department = '{department}' AND o.key_version <> {to_version} AND {selected}
+                      AND n.department = o.department AND n.id = o.id AND n.key_version = {to_version}
+                    RETURNING o.token AS old_token, n.token AS new_token;'''
+
+        return [(row.old_token, row.new_token) for row in self.send_query(query).all()]
+
+    def tokens_of_version(self, department : str, key_version : int, tokens : List[str]) -> List[str]:
+
+        '''
+        Method to find which of a batch of a department's tokens are of a key version
+        '''
+
+        if not tokens:
+            return []
+
+        query = f'''SELECT token FROM id_tokens
+                    WHERE department = '{department}' AND key_version = {key_version}
+                      AND token IN ({', '.join(repr(token) for token in tokens)});'''
+
+        return [row.token for row in self.send_query(query).all()]
+
+    def count_tokens_not_reissued(self, department : str, key_version : int) -> int:
+
+        '''
+        Method to count a department's tokens of a key version whose replacement has not been handed out
+        '''
+
+        query = f'''SELECT COUNT(*) FROM id_tokens
+                    WHERE department = '{department}' AND key_version = {key_version} AND reissued_at IS NULL;'''
+
+        return self.send_query(query).export('df')['count'].to_list()[0]
+
+    def register_ids_after(self, last_id : int, batch_size : int) -> List[int]:
+
+        '''
+        Method to page through id_register in id order
+        Inputs: last_id - only ids strictly greater than this are returned
+                batch_size - maximum number of ids to return
+        Output: list of ids, empty once the table is exhausted
+        '''
+
+        query = f'''SELECT id FROM id_register WHERE id > {last_id}
+                    ORDER BY id LIMIT {batch_size};'''
+
+        return [row.id for row in self.send_read_query(query).all()]
+
+    def delete_id_tokens(self, department : str, key_version : int, batch_size : int) -> int:
+
+        '''
+        Method to delete up to batch_size tokens of a retired key version
+        Inputs: department, key_version - the tokens to remove
+                batch_size - maximum number of rows to delete in one statement
+        Output: number of rows deleted
+        '''
+
+        query = f'''DELETE FROM id_tokens WHERE (department, token) IN
+                    (SELECT department, token FROM id_tokens
+                     WHERE department = '{department}' AND key_version = {key_version}
+                     LIMIT {batch_size})
+                    RETURNING id;'''
+
+        return len(self.send_query(query).all())
+
+    def ids_in_table(self, table : str, ids : List[int]) -> List[int]:
+
+        '''
+        Method to find which of a batch of ids are already present in a table
+        Inputs: table - table name with an id column e.g. 'id_register' or 'health_table'
+                ids - list of ids to check
+        Output: list of the ids that are present
+        '''
+
+        if not ids:
+            return []
+
+        id_list = ', '.join(str(int(id)) for id in ids)
+
+        query = f'''SELECT id FROM {table} WHERE id IN ({id_list});'''
+
+        # usually none are present, and an empty result exports as a dataframe with no columns
+        return [row.id for row in self.send_query(query).all()]
+
+    def insert_health_records_batch(self, records : List[Dict]) -> None:
+
+        '''
+        Method to batch insert already validated records into health table
+        Inputs: a list of dictionaries, each of the form taken by insert_health_records
+        '''
+
+        keys = ['id', 'registered_doctor', 'has_asthma', 'has_registered_disability']
+
+        values = [tuple(record[key] for key in keys) for record in records]
+
+        query = '''
+        INSERT INTO health_table
+            (id, registered_doctor, has_asthma, has_registered_disability)
+        VALUES %s
+        '''
+        self.execute_values(query, values)
+
+        return
+
+    def register_insert_records_batch(self, records : List[Dict]) -> None:
+
+        '''
+        Method to batch insert already validated records into id_register
+        Inputs: a list of dictionaries of the form {'id': 13, 'name': 'david'}
+        '''
+
+        values = [(record['id'], record['name']) for record in records]
+
+        query = '''
+        INSERT INTO id_register
+            (id, name)
+        VALUES %s
+        '''
+        self.execute_values(query, values)
+
+        return
+
+    def health_eligibility_rows(self):
+
+        '''
+        Method to export the eligibility attributes of every row of the health table
+        Output: dataframe with columns id, has_asthma, has_registered_disability
+        Note: read from the primary, not a replica, so it is consistent with change_log_xmin().
+        '''
+
+        query = '''SELECT id, has_asthma, has_registered_disability FROM health_table;'''
+
+        return self.send_query(query).export('df')
+
+    def change_log_xmin(self) -> int:
+
+        '''
+        Method to get the oldest transaction id still in progress
+        Every change_log row with a txid below this is final, nothing new will appear below it.
+        '''
+
+        query = '''SELECT txid_snapshot_xmin(txid_current_snapshot()) AS xmin;'''
+
+        return int(self.send_query(query).export('df')['xmin'].to_list()[0])
+
+    def changed_row_ids(self, table_name : str, since_txid : int) -> List[int]:
+
+        '''
+        Method to find the ids of a table written by transactions at or after since_txid
+        Inputs: table_name - 'health_table' or 'id_register'
+                since_txid - usually a change_log_xmin() taken earlier
+        '''
+
+        query = f'''SELECT DISTINCT row_id FROM change_log
+                    WHERE txid >= {since_txid} AND table_name = '{table_name}';'''
+
+        # usually nothing has changed, and an empty result exports as a dataframe with no columns
+        return [row.row_id for row in self.send_query(query).all()]
+
+    def change_log_batch(self, after_txid : int, after_seq : int, batch_size : int):
+
+        '''
+        Method to read the next batch of finished changes after a consumer position
+        Inputs: after_txid, after_seq - position of the last change already processed
+                batch_size - maximum number of changes to return
+        Output: dataframe of change_log rows ordered by (txid, seq)
+        Note: only rows from transactions below change_log_xmin() are returned, so a
+              transaction that commits later can never land behind the position.
+        '''
+
+        query = f'''SELECT seq, txid, table_name, row_id, operation, changed_at FROM change_log
+                    WHERE (txid, seq) > ({after_txid}, {after_seq})
+                      AND txid < txid_snapshot_xmin(txid_current_snapshot())
+                    ORDER BY txid, seq LIMIT {batch_size};'''
+
+        return self.send_query(query).export('df')
+
+    def change_log_position(self, consumer : str) -> tuple:
+
+        '''
+        Method to get a consumer's acknowledged position, registering the consumer at the start if new
+        Output: (acked_txid, acked_seq)
+        '''
+
+        query_register = f'''INSERT INTO change_log_consumers (consumer) VALUES ('{consumer}')
+                             ON CONFLICT DO NOTHING'''
+        self.send_query(query_register)
+
+        query = f"SELECT acked_txid, acked_seq FROM change_log_consumers WHERE consumer = '{consumer}'"
+
+        position = self.send_query(query).export('df')
+
+        return (int(position['acked_txid'].to_list()[0]), int(position['acked_seq'].to_list()[0]))
+
+    def ack_change_log(self, consumer : str, txid : int, seq : int) -> None:
+
+        '''
+        Method to record that a consumer has processed every change up to and including (txid, seq)
+        '''
+
+        query = f'''UPDATE change_log_consumers
+                    SET acked_txid = {txid}, acked_seq = {seq}, record_updated_at = now()
+                    WHERE consumer = '{consumer}'
+                '''
+        self.send_query(query)
+
+        return
+
+    def prune_change_log(self) -> int:
+
+        '''
+        Method to delete changes every registered consumer has acknowledged
+        Holds taken with hold_change_log() are consumers too, so rows a snapshot still needs are kept.
+        Output: number of rows deleted
+        '''
+
+        query = '''DELETE FROM change_log WHERE (txid, seq) <=
+                    (SELECT acked_txid, acked_seq FROM change_log_consumers
+                     ORDER BY acked_txid, acked_seq LIMIT 1)
+                    RETURNING seq;'''
+
+        return len(self.send_query(query).all())
+
+    def hold_change_log(self, consumer : str) -> int:
+
+        '''
+        Method to stop change_log being pruned from the oldest transaction still in progress onwards
+        Registers (or moves) consumer just before change_log_xmin(), in one statement so no prune
+        can run between reading the xmin and holding it.
+        Output: the held txid, every change_log row at or after it is kept until the hold moves
+        '''
+
+        query = f'''INSERT INTO change_log_consumers (consumer, acked_txid, acked_seq)
+                    VALUES ('{consumer}', txid_snapshot_xmin(txid_current_snapshot()) - 1, 9223372036854775807)
+                    ON CONFLICT (consumer) DO UPDATE
+                    SET acked_txid = EXCLUDED.acked_txid, acked_seq = EXCLUDED.acked_seq, record_updated_at = now()
+                    RETURNING acked_txid;'''
+
+        return int(self.send_query(query).export('df')['acked_txid'].to_list()[0]) + 1
+
+    def change_log_hold(self, consumer : str) -> int:
+
+        '''
+        Method to get the txid held by hold_change_log(), None if the consumer is not registered
+        '''
+
+        query = f"SELECT acked_txid FROM change_log_consumers WHERE consumer = '{consumer}'"
+
+        held = [row.acked_txid for row in self.send_query(query).all()]
+
+        return int(held[0]) + 1 if held else None
+
+    def drop_change_log_consumer(self, consumer : str) -> None:
+
+        '''
+        Method to unregister a consumer or hold, so it no longer stops change_log being pruned
+        '''
+
+        query = f"DELETE FROM change_log_consumers WHERE consumer = '{consumer}'"
+        self.send_query(query)
+
+        return
+
+    def try_advisory_xact_lock(self, lock_class : int, key : int) -> bool:
+
+        '''
+        Method to take a transaction level advisory lock without waiting
+        Output: True if the lock was taken, it is then held until the current transaction ends
+        '''
+
+        query = f"SELECT pg_try_advisory_xact_lock({lock_class}, {key}) AS locked;"
+
+        return bool(self.send_query(query).export('df')['locked'].to_list()[0])
+
+    def department_tokens(self, department : str):
+
+        '''
+        Method to export every token issued to a department, across all key versions
+        Output: dataframe with columns token, id
+        '''
+
+        query = f"SELECT token, id FROM id_tokens WHERE department = '{department}'"
+
+        return self.send_query(query).export('df')
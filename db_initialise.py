@@ -6,7 +6,9 @@ import records
 import logging
 import psycopg2
 import psycopg2.extras
+from contextlib import contextmanager
 from psycopg2.extras import Json, DictCursor
+from replica_routing import ReplicaRouter
 
 logging.basicConfig(format='%(name)s - %(asctime)s - %(message)s',
     datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
@@ -14,6 +16,16 @@ logger = logging.getLogger('ID System')
 
 class DatabaseInitialLogin(object):
 
+    # read replicas, e.g. [{'host': '127.0.0.1', 'port': 5433}], sharing the user, password and database below.
+    # Leave empty to send every query to the primary.
+    REPLICAS = []
+
+    # reads go to the primary instead of a replica lagging more than this
+    MAX_REPLICA_LAG_SECONDS = 5
+
+    # after a write a thread reads from the primary for this long, so it sees its own writes
+    READ_YOUR_WRITES_SECONDS = 5
+
     def __init__(self):
 
         u = 'davidbutler'
@@ -34,7 +46,51 @@ class DatabaseInitialLogin(object):
         self.conn = psycopg2.connect(**self.dbargs)
         self.cur = self.conn.cursor(cursor_factory=DictCursor)
 
+        # records connection of the open transaction, None outside transaction()
+        self.tx_conn = None
+
+        # routes send_read_query to the replicas, None when there are none
+        self.router = None
+        if self.REPLICAS:
+            replica_urls = [f"postgres://{u}:{p}@{replica['host']}:{replica['port']}/{d}" for replica in self.REPLICAS]
+            self.router = ReplicaRouter.shared(replica_urls, self.MAX_REPLICA_LAG_SECONDS, self.READ_YOUR_WRITES_SECONDS)
+
+    @contextmanager
+    def transaction(self):
+
+        '''
+        Context manager running every send_query and execute_values inside it in one transaction
+        Commits when the block exits, rolls back and re-raises if it raises.
+        A transaction() opened inside another one joins the outer transaction.
+        e.g. with db.transaction():
+                 db.register_insert_record(record)
+                 db.insert_id_tokens(token_rows)
+        '''
+
+        if self.tx_conn is not None:
+            yield self
+            return
+
+        conn = self.db.get_connection()
+        tx = conn.transaction()
+        self.tx_conn = conn
+
+        try:
+            yield self
+            tx.commit()
+        except:
+            tx.rollback()
+            raise
+        finally:
+            self.tx_conn = None
+            conn.close()
+
     def send_query(self, query):
+        if self.router is not None and not query.lstrip().upper().startswith('SELECT'):
+            self.router.record_write()
+        if self.tx_conn is not None:
+            # no reconnect inside a transaction, the statements before it would be lost
+            return self.tx_conn.query(query)
         try:
             ans = self.db.query(query)
         except psycopg2.OperationalError as e:
@@ -43,7 +99,23 @@ class DatabaseInitialLogin(object):
             ans = self.db.query(query)
         return ans
 
+    def send_read_query(self, query):
+        '''
+        Run a SELECT on a replica when one is healthy and up to date enough, otherwise on the primary
+        Inside a transaction, or shortly after this thread has written, it always runs on the primary.
+        '''
+        if self.router is None or self.tx_conn is not None:
+            return self.send_query(query)
+        return self.router.read(query, self.send_query)
+
     def execute_values(self, query, values):
+        if self.router is not None:
+            self.router.record_write()
+        if self.tx_conn is not None:
+            # run on the transaction's connection and leave the commit to transaction()
+            cur = self.tx_conn._conn.connection.cursor()
+            psycopg2.extras.execute_values(cur, query, values)
+            return
         try:
             psycopg2.extras.execute_values(self.cur, query, values)
             self.conn.commit()
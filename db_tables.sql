@@ -20,3 +20,72 @@ CREATE TABLE IF NOT EXISTS health_table (
        record_created_at TIMESTAMP DEFAULT now(),
        record_updated_at TIMESTAMP DEFAULT now()
    );
+
+  CREATE TABLE IF NOT EXISTS id_tokens (
+       department TEXT,
+       key_version INT,
+       token TEXT,
+       id INT REFERENCES id_register(id),
+       record_created_at TIMESTAMP DEFAULT now(),
+       reissued_at TIMESTAMP,
+       CONSTRAINT id_tokens_pk PRIMARY KEY (department, token),
+       CONSTRAINT id_tokens_department_version_id_key UNIQUE (department, key_version, id)
+   );
+
+  -- set when the department has been given the current version token in place of this one (see pseudonyms.py)
+  ALTER TABLE id_tokens ADD COLUMN IF NOT EXISTS reissued_at TIMESTAMP;
+
+  CREATE INDEX IF NOT EXISTS health_table_record_updated_at_idx ON health_table (record_updated_at);
+
+  -- change feed: every insert or update of health_table and id_register writes a row here from a trigger,
+  -- so the change is committed (or rolled back) in the same transaction as the write itself.
+  -- txid lets consumers read only changes from transactions that have finished (see change_feed.py).
+
+  CREATE TABLE IF NOT EXISTS change_log (
+       seq BIGSERIAL CONSTRAINT change_log_pk PRIMARY KEY,
+       txid BIGINT NOT NULL DEFAULT txid_current(),
+       table_name TEXT,
+       row_id INT,
+       operation TEXT,
+       changed_at TIMESTAMP DEFAULT now()
+   );
+
+  CREATE INDEX IF NOT EXISTS change_log_txid_seq_idx ON change_log (txid, seq);
+
+  CREATE TABLE IF NOT EXISTS change_log_consumers (
+       consumer TEXT CONSTRAINT change_log_consumers_pk PRIMARY KEY,
+       acked_txid BIGINT DEFAULT 0,
+       acked_seq BIGINT DEFAULT 0,
+       record_created_at TIMESTAMP DEFAULT now(),
+       record_updated_at TIMESTAMP DEFAULT now()
+   );
+
+  CREATE OR REPLACE FUNCTION log_row_change() RETURNS trigger AS $$
+  BEGIN
+       INSERT INTO change_log (table_name, row_id, operation) VALUES (TG_TABLE_NAME, NEW.id, TG_OP);
+       RETURN NEW;
+  END;
+  $$ LANGUAGE plpgsql;
+
+  CREATE OR REPLACE FUNCTION set_record_updated_at() RETURNS trigger AS $$
+  BEGIN
+       NEW.record_updated_at = now();
+       RETURN NEW;
+  END;
+  $$ LANGUAGE plpgsql;
+
+  DROP TRIGGER IF EXISTS health_table_change_log ON health_table;
+  CREATE TRIGGER health_table_change_log AFTER INSERT OR UPDATE ON health_table
+       FOR EACH ROW EXECUTE PROCEDURE log_row_change();
+
+  DROP TRIGGER IF EXISTS id_register_change_log ON id_register;
+  CREATE TRIGGER id_register_change_log AFTER INSERT OR UPDATE ON id_register
+       FOR EACH ROW EXECUTE PROCEDURE log_row_change();
+
+  DROP TRIGGER IF EXISTS health_table_record_updated_at ON health_table;
+  CREATE TRIGGER health_table_record_updated_at BEFORE UPDATE ON health_table
+       FOR EACH ROW EXECUTE PROCEDURE set_record_updated_at();
+
+  DROP TRIGGER IF EXISTS id_register_record_updated_at ON id_register;
+  CREATE TRIGGER id_register_record_updated_at BEFORE UPDATE ON id_register
+       FOR EACH ROW EXECUTE PROCEDURE set_record_updated_at();
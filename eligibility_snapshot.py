@@ -0,0 +1,356 @@
+import os
+import json
+import logging
+import argparse
+import datetime
+import numpy as np
+from typing import List, Dict, Any
+from database_operations import DatabaseQueries, is_valid_token
+
+
+logging.basicConfig(
+    format="%(name)s - %(asctime)s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("Eligibility Snapshot")
+
+# --------------
+# File layout
+# --------------
+
+# HEADER_SIZE bytes of JSON header, padded with spaces, followed by the sections listed in header['offsets']:
+#   present                   - packed bits, 1 if the id has a row in health_table
+#   has_asthma                - packed bits indexed by id
+#   has_registered_disability - packed bits indexed by id
+#   token_prefix              - sorted uint64, first 8 bytes of each of the department's tokens
+#   token_id                  - int64 id for each entry of token_prefix
+#   token_digest              - uint8, the full 32 byte digest for each entry of token_prefix
+# Every section starts on an 8 byte boundary so it can be mapped straight into a numpy array.
+# header['change_hold'] names the change_log_consumers row that keeps the change_log rows the
+# snapshot needs from being pruned (see hold_name()).
+
+SNAPSHOT_MAGIC = 'IDSNAP'
+SNAPSHOT_FORMAT = 4
+HEADER_SIZE = 4096
+
+ATTRIBUTES = ['has_asthma', 'has_registered_disability']
+
+
+def _token_prefix(tokens : List[str]) -> np.ndarray:
+
+    # a token is a hex HMAC-SHA256 digest, its first 16 hex characters are the first 8 bytes
+    return np.array([int(token[:16], 16) for token in tokens], dtype=np.uint64)
+
+
+def _token_digest(tokens : List[str]) -> np.ndarray:
+
+    # one row of 32 bytes per token
+    return np.frombuffer(b''.join(bytes.fromhex(token) for token in tokens), dtype=np.uint8).reshape(-1, 32)
+
+
+def hold_name(path : str, department : str) -> str:
+
+    # one hold per snapshot file, moved forward each time the file is rebuilt
+    return f'snapshot:{department}:{os.path.abspath(path)}'
+
+
+def _previous_version(path : str) -> int:
+
+    # the version of the file being replaced, read from its header alone so a file of an older
+    # format (or not a snapshot at all) restarts the count instead of failing the build
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.read(HEADER_SIZE).decode())
+        if header.get('magic') == SNAPSHOT_MAGIC:
+            return int(header['version'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    return 0
+
+
+class EligibilitySnapshotBuilder(DatabaseQueries):
+
+    SNAPSHOT_LOG = "logs/eligibility_snapshot_log.json"
+
+    def __init__(self):
+        self.logger = logging.getLogger('Eligibility Snapshot')
+
+    def build(self, path : str, department : str, password : str, max_staleness_seconds : int = 300) -> Dict[str, Any]:
+
+        """
+        Method to export health_table into a snapshot file for a department
+        Inputs: path - file to write, replaced atomically so open readers keep their old copy
+                department, password - the department the snapshot is for, checked against health_dept_access
+                max_staleness_seconds - age after which readers stop trusting the snapshot
+        Output: the snapshot header, None if access is not granted
+        """
+
+        db = DatabaseQueries()
+
+        if not db.health_dept_access_granted(department, password):
+            logger.info(f"access not granted to build a snapshot for {department}")
+            return None
+
+        # taken before reading: every transaction below change_txid has finished and is in the export,
+        # anything at or above it may not be and is treated as changed by readers. The hold keeps
+        # change_log from change_txid onwards until the file is rebuilt or retired.
+        taken_at = datetime.datetime.now()
+        change_hold = hold_name(path, department)
+        change_txid = db.hold_change_log(change_hold)
+
+        # an empty result exports as a dataframe with no columns, give it its columns so an
+        # empty table makes an empty snapshot
+        rows = db.health_eligibility_rows().reindex(columns=['id'] + ATTRIBUTES)
+        tokens = db.department_tokens(department).reindex(columns=['token', 'id'])
+
+        ids = np.asarray(rows['id'].to_list(), dtype=np.int64)
+        id_space = int(ids.max()) + 1 if len(ids) else 0
+
+        sections = {}
+
+        present = np.zeros(id_space, dtype=bool)
+        present[ids] = True
+        sections['present'] = np.packbits(present)
+
+        for attribute in ATTRIBUTES:
+            bits = np.zeros(id_space, dtype=bool)
+            # a NULL attribute is stored as False
+            bits[ids] = rows[attribute].fillna(False).astype(bool).to_numpy()
+            sections[attribute] = np.packbits(bits)
+
+        tokens = tokens[tokens['token'].map(is_valid_token).astype(bool)]
+
+        prefix = _token_prefix(tokens['token'].to_list())
+        digest = _token_digest(tokens['token'].to_list())
+        token_ids = np.asarray(tokens['id'].to_list(), dtype=np.int64)
+        order = np.argsort(prefix, kind='stable')
+        prefix, digest, token_ids = prefix[order], digest[order], token_ids[order]
+
+        # drop prefixes shared by more than one token, those tokens are resolved by the database instead
+        if len(prefix):
+            unique = np.ones(len(prefix), dtype=bool)
+            duplicated = prefix[1:] == prefix[:-1]
+            unique[1:] &= ~duplicated
+            unique[:-1] &= ~duplicated
+            prefix, digest, token_ids = prefix[unique], digest[unique], token_ids[unique]
+
+        sections['token_prefix'] = prefix
+        sections['token_id'] = token_ids
+        sections['token_digest'] = digest.ravel()
+
+        version = _previous_version(path) + 1
+
+        offsets = {}
+        position = HEADER_SIZE
+        for name, array in sections.items():
+            offsets[name] = [position, str(array.dtype), len(array)]
+            position += -(-array.nbytes // 8) * 8
+
+        header = {'magic': SNAPSHOT_MAGIC,
+                  'format': SNAPSHOT_FORMAT,
+                  'version': version,
+                  'department': department,
+                  'taken_at': str(taken_at),
+                  'change_txid': change_txid,
+                  'change_hold': change_hold,
+                  'max_staleness_seconds': max_staleness_seconds,
+                  'id_space': id_space,
+                  'offsets': offsets}
+
+        encoded_header = json.dumps(header).encode()
+        if len(encoded_header) > HEADER_SIZE:
+            raise ValueError('snapshot header is larger than HEADER_SIZE')
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded_header.ljust(HEADER_SIZE, b' '))
+            for name, array in sections.items():
+                f.seek(offsets[name][0])
+                f.write(array.tobytes())
+            f.truncate(position)
+        os.replace(tmp_path, path)
+
+        logger.info(f"wrote snapshot version {version} of {len(ids)} ids to {path}")
+
+        with open(self.SNAPSHOT_LOG, mode="a+", encoding="utf-8") as f:
+            f.write(f"{header} \r\n")
+
+        return header
+
+    def retire(self, path : str, department : str) -> None:
+
+        """
+        Method to delete a snapshot that is no longer used and release its change_log hold
+        Note: a snapshot file removed any other way leaves its hold behind, and change_log
+              is then never pruned past it.
+        """
+
+        db = DatabaseQueries()
+
+        db.drop_change_log_consumer(hold_name(path, department))
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        logger.info(f"retired snapshot {path} for {department}")
+
+        return
+
+
+class EligibilitySnapshot(object):
+
+    """
+    Read only view of a snapshot file. Every section is a numpy memmap of the file, so lookups
+    copy nothing and all processes that open the same file share one copy in the page cache.
+    """
+
+    # how often the list of ids changed since the snapshot is re-read from the database
+    CHANGED_IDS_REFRESH_SECONDS = 1
+
+    def __init__(self, path : str):
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.header = json.loads(f.read(HEADER_SIZE).decode())
+
+        if self.header.get('magic') != SNAPSHOT_MAGIC or self.header.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f'{path} is not an eligibility snapshot')
+
+        self.taken_at = datetime.datetime.fromisoformat(self.header['taken_at'])
+        self.id_space = self.header['id_space']
+
+        self.sections = {}
+        for name, (offset, dtype, length) in self.header['offsets'].items():
+            if length:
+                self.sections[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(length,))
+            else:
+                self.sections[name] = np.zeros(0, dtype=dtype)
+
+        self._changed_ids = np.zeros(0, dtype=np.int64)
+        self._changed_ids_read_at = None
+
+        # set by changed_ids() once the file has been rebuilt or retired, the change_log rows
+        # after change_txid may then be pruned and the changed ids can no longer be trusted
+        self.superseded = False
+
+    def is_stale(self) -> bool:
+
+        if self.superseded:
+            return True
+
+        age = (datetime.datetime.now() - self.taken_at).total_seconds()
+
+        return age > self.header['max_staleness_seconds']
+
+    def _bits(self, name : str, ids : np.ndarray) -> np.ndarray:
+
+        packed = self.sections[name]
+
+        return ((packed[ids >> 3] >> (7 - (ids & 7)).astype(np.uint8)) & 1).astype(bool)
+
+    def changed_ids(self, db : DatabaseQueries) -> np.ndarray:
+
+        """
+        Method to get the ids written after the snapshot was taken, re-read from change_log
+        at most every CHANGED_IDS_REFRESH_SECONDS.
+        Note: marks the snapshot superseded if its change_log hold has moved, check is_stale() afterwards.
+        """
+
+        now = datetime.datetime.now()
+
+        if self._changed_ids_read_at is None or (now - self._changed_ids_read_at).total_seconds() > self.CHANGED_IDS_REFRESH_SECONDS:
+            self._changed_ids = np.asarray(db.changed_row_ids('health_table', self.header['change_txid']), dtype=np.int64)
+            self._changed_ids_read_at = now
+
+            # checked after reading: if the hold was still ours then, nothing we read had been pruned
+            if db.change_log_hold(self.header['change_hold']) != self.header['change_txid']:
+                logger.info(f"snapshot version {self.header['version']} of {self.path} has been superseded")
+                self.superseded = True
+
+        return self._changed_ids
+
+    def lookup(self, attribute : str, ids) -> Dict[str, np.ndarray]:
+
+        """
+        Method to look up an attribute for a batch of ids
+        Inputs: attribute - 'has_asthma' or 'has_registered_disability'
+                ids - int or array of ids
+        Output: {'value': bool array, 'present': bool array}, present is False for ids with no health_table row
+        """
+
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+
+        if not self.id_space:
+            return {'value': np.zeros(len(ids), dtype=bool), 'present': np.zeros(len(ids), dtype=bool)}
+
+        in_range = (ids >= 0) & (ids < self.id_space)
+        safe_ids = np.where(in_range, ids, 0)
+
+        present = in_range & self._bits('present', safe_ids)
+        value = present & self._bits(attribute, safe_ids)
+
+        return {'value': value, 'present': present}
+
+    def resolve_tokens(self, tokens : List[str]) -> np.ndarray:
+
+        """
+        Method to map a batch of the department's tokens to ids
+        Output: int64 array of ids, -1 where the token is not in the snapshot or is not a valid token
+        Note: the prefix only finds the candidate entry, a token matches only if its whole digest does.
+        """
+
+        prefix = self.sections['token_prefix']
+        token_ids = self.sections['token_id']
+        digest = self.sections['token_digest'].reshape(-1, 32)
+
+        valid = np.array([is_valid_token(token) for token in tokens], dtype=bool)
+        resolved = np.full(len(tokens), -1, dtype=np.int64)
+
+        if not len(prefix) or not valid.any():
+            return resolved
+
+        valid_tokens = [token for token, is_valid in zip(tokens, valid) if is_valid]
+        wanted = _token_prefix(valid_tokens)
+
+        position = np.minimum(np.searchsorted(prefix, wanted), len(prefix) - 1)
+        found = (prefix[position] == wanted) & (digest[position] == _token_digest(valid_tokens)).all(axis=1)
+
+        resolved[valid] = np.where(found, token_ids[position], -1)
+
+        return resolved
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output',
+            dest='output',
+            help='path of snapshot file to write')
+    parser.add_argument('-dept', '--department',
+            dest='department',
+            help='department the snapshot is for')
+    parser.add_argument('-p', '--password',
+            dest='password',
+            help='password of department')
+    parser.add_argument('-s', '--max_staleness',
+            dest='max_staleness',
+            type=int,
+            default=300,
+            help='seconds after which the snapshot is not trusted')
+    parser.add_argument('-r', '--retire',
+            dest='retire',
+            default=False,
+            help='Set to true to delete the snapshot and release its change_log hold')
+
+    args = parser.parse_args()
+
+    b = EligibilitySnapshotBuilder()
+
+    if args.retire:
+        b.retire(args.output, args.department)
+    else:
+        print(b.build(args.output, args.department, args.password, args.max_staleness))
@@ -0,0 +1,202 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import List, Dict, Any, Callable
+from database_operations import DatabaseQueries
+
+
+logging.basicConfig(
+    format="%(name)s - %(asctime)s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("Group Commit")
+
+class GroupCommit(object):
+
+    # --------------
+    # Group commit
+    # --------------
+
+    # Service operations submitted from many threads are run by one committer thread.
+    # It waits up to window_ms after the first operation for others to arrive, runs them all in a
+    # single transaction (each in its own savepoint, so one failing does not undo the others),
+    # commits once, and only then hands each caller its result.
+    # One commit, and so one fsync on Postgres, is shared by every operation in the group.
+    # If the committer thread cannot connect, or fails outside a group, it stops: every queued
+    # operation fails with the error and later submits raise instead of waiting forever.
+
+    def __init__(self, window_ms : float = 5, max_group_size : int = 100):
+
+        self.logger = logging.getLogger('Group Commit')
+        self.window_ms = window_ms
+        self.max_group_size = max_group_size
+
+        self.pending = queue.Queue()
+        self.stopped = False
+        self.error = None
+
+        # replica router of the committer's connection, set once it has connected
+        self.router = None
+
+        # held while checking stopped and queueing, so nothing is queued after the committer has failed
+        self.lock = threading.Lock()
+
+        self.stats = {'groups': 0, 'operations': 0}
+
+        self.thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self.thread.start()
+
+    def submit(self, operation : Callable[[DatabaseQueries], Any]) -> Future:
+
+        """
+        Method to queue a unit of work for the next group
+        Input: operation - function taking a DatabaseQueries, all its statements run in the group's transaction
+        Output: future resolving to the operation's return value once the group has committed
+        Note: the write is made on the committer thread, use run() so the caller's own reads are
+              sent to the primary afterwards.
+        """
+
+        future = Future()
+
+        with self.lock:
+            if self.error is not None:
+                raise RuntimeError(f'group commit committer failed: {self.error}')
+            if self.stopped:
+                raise RuntimeError('group commit has been stopped')
+
+            self.pending.put((operation, future))
+
+        return future
+
+    def run(self, operation : Callable[[DatabaseQueries], Any]) -> Any:
+
+        """
+        Method to submit an operation and wait for it to be committed
+        The write is recorded on the calling thread, so its next reads see it (see ReplicaRouter).
+        """
+
+        future = self.submit(operation)
+
+        try:
+            return future.result()
+        finally:
+            if self.router is not None:
+                self.router.record_write()
+
+    def stop(self) -> None:
+
+        """
+        Method to commit anything still queued and stop the committer thread
+        """
+
+        with self.lock:
+            self.stopped = True
+            self.pending.put(None)
+
+        self.thread.join()
+
+        return
+
+    def _next_group(self) -> List[tuple]:
+
+        first = self.pending.get()
+
+        if first is None:
+            return None
+
+        group = [first]
+        deadline = time.monotonic() + self.window_ms / 1000
+
+        while len(group) < self.max_group_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # put the stop marker back so the loop ends after this group
+                self.pending.put(None)
+                break
+            group.append(item)
+
+        return group
+
+    def _fail(self, error : Exception) -> None:
+
+        logger.info(f"group commit stopped, failing queued operations: {error}")
+
+        with self.lock:
+            self.stopped = True
+            self.error = error
+
+        # nothing can be queued now, fail everything that already was
+        while True:
+            try:
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(error)
+
+        return
+
+    def _run(self) -> None:
+
+        try:
+            self._commit_groups()
+        except Exception as e:
+            self._fail(e)
+
+        return
+
+    def _commit_groups(self) -> None:
+
+        db = DatabaseQueries()
+        self.router = db.router
+
+        while True:
+            group = self._next_group()
+
+            if group is None:
+                break
+
+            results = []
+
+            try:
+                with db.transaction():
+                    for i, (operation, future) in enumerate(group):
+                        db.send_query(f'SAVEPOINT group_commit_{i}')
+                        try:
+                            result = operation(db)
+                        except Exception as e:
+                            db.send_query(f'ROLLBACK TO SAVEPOINT group_commit_{i}')
+                            results.append((future, None, e))
+                            continue
+                        try:
+                            db.send_query(f'RELEASE SAVEPOINT group_commit_{i}')
+                        except Exception:
+                            # the operation caught its own database error, drop its statements only
+                            db.send_query(f'ROLLBACK TO SAVEPOINT group_commit_{i}')
+                        results.append((future, result, None))
+
+            except Exception as e:
+                logger.info(f"group of {len(group)} operations failed to commit: {e}")
+                for operation, future in group:
+                    future.set_exception(e)
+                continue
+
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+            self.stats['groups'] += 1
+            self.stats['operations'] += len(group)
+
+        return
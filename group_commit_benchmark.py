@@ -0,0 +1,93 @@
+import time
+import logging
+import argparse
+import threading
+from database_operations import DatabaseQueries
+from group_commit import GroupCommit
+
+
+# Benchmark of concurrent health_table updates, committed one at a time versus grouped.
+# Each thread keeps its own connection in the one-at-a-time run, so the difference measured
+# is the number of commits rather than connection setup.
+# RUN: python group_commit_benchmark.py -t 32 -n 200 -w 5
+
+logging.getLogger('database operations').setLevel(logging.WARNING)
+
+
+def update_for(id : int, i : int):
+
+    record_to_update = {'registered_doctor': f'doctor{i}',
+                        'has_asthma': None,
+                        'has_registered_disability': None}
+
+    return lambda db: db.update_health_record(id, record_to_update)
+
+
+def run_threads(threads : int, per_thread : int, ids, work) -> float:
+
+    def worker(t):
+        for i in range(per_thread):
+            work(t, ids[(t * per_thread + i) % len(ids)], i)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--threads',
+            dest='threads',
+            type=int,
+            default=32,
+            help='number of concurrent writers')
+    parser.add_argument('-n', '--per_thread',
+            dest='per_thread',
+            type=int,
+            default=200,
+            help='updates per writer')
+    parser.add_argument('-w', '--window_ms',
+            dest='window_ms',
+            type=float,
+            default=5,
+            help='group commit window in milliseconds')
+
+    args = parser.parse_args()
+
+    # records exports an empty result without an id column, so read the rows instead of indexing it
+    ids = [row.id for row in DatabaseQueries().send_query('SELECT id FROM health_table;').all()]
+
+    if not ids:
+        raise SystemExit('health_table is empty, insert some records first')
+
+    total = args.threads * args.per_thread
+
+    # one transaction and commit per update
+    connections = [DatabaseQueries() for _ in range(args.threads)]
+
+    def single(t, id, i):
+        db = connections[t]
+        with db.transaction():
+            update_for(id, i)(db)
+
+    elapsed = run_threads(args.threads, args.per_thread, ids, single)
+    print(f"commit per update: {total} updates in {elapsed:.2f}s, {total / elapsed:.0f} updates/s")
+
+    # grouped commits
+    group_commit = GroupCommit(window_ms=args.window_ms)
+
+    def grouped(t, id, i):
+        group_commit.run(update_for(id, i))
+
+    elapsed = run_threads(args.threads, args.per_thread, ids, grouped)
+    group_commit.stop()
+
+    print(f"group commit:      {total} updates in {elapsed:.2f}s, {total / elapsed:.0f} updates/s, "
+          f"{group_commit.stats['operations'] / max(group_commit.stats['groups'], 1):.1f} updates per commit")
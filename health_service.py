@@ -9,6 +9,8 @@ import datetime
 from jsonschema import validate
 from typing import List, Dict, Any
 from database_operations import DatabaseQueries
+from group_commit import GroupCommit
+from admission_control import AdmissionController, admitted
 
 
 logging.basicConfig(
@@ -23,9 +25,22 @@ class HealthServiceClient(DatabaseQueries):
     HEALTH_TABLE_INSERT_LOG = "logs/health_table_insert_log.json"
     HEALTH_TABLE_QUERY_LOG = "logs/health_table_query_log.json"
     HEALTH_TABLE_UPDATE_LOG = "logs/health_table_update_log.json"
+    DEPT_NAME = 'health_dept'
+
+    def __init__(self, group_commit : GroupCommit = None, admission : AdmissionController = None, priority : str = 'interactive'):
+
+        """
+        Inputs: group_commit - optional, if given inserts and updates are committed in groups
+                with other concurrent writes instead of one commit each (see group_commit.py)
+                admission - optional, if given every call waits for a slot before using the
+                database and may raise AdmissionRejected (see admission_control.py)
+                priority - 'interactive' or 'bulk', the admission priority of this client's calls
+        """
 
-    def __init__(self):
         self.logger = logging.getLogger('Health Service')
+        self.group_commit = group_commit
+        self.admission = admission
+        self.priority = priority
 
     def health_table_insert(self, id : int, registered_doctor : str, has_asthma : bool, has_registered_disability : bool) -> str:
 
@@ -41,11 +56,43 @@ class HealthServiceClient(DatabaseQueries):
                   'has_asthma': has_asthma,
                   'has_registered_disability': has_registered_disability}
 
-        # initialise DB
-        db = DatabaseQueries()
-
         # initialise log
-        insert_log = record
+        insert_log = dict(record)
+
+        with admitted(self.admission, self.DEPT_NAME, self.priority):
+
+            # the registration and duplicate checks and the insert run as one unit of work,
+            # the log is only written once it has committed or failed
+            try:
+                if self.group_commit is not None:
+                    output = self.group_commit.run(lambda db: self._health_table_insert(db, record, insert_log))
+                else:
+                    # initialise DB
+                    db = DatabaseQueries()
+
+                    with db.transaction():
+                        output = self._health_table_insert(db, record, insert_log)
+            except Exception as e:
+                logger.info(f"Insert was not committed: {e}")
+                insert_log["successful"] = False
+                self._write_log(self.HEALTH_TABLE_INSERT_LOG, insert_log)
+                raise
+
+        self._write_log(self.HEALTH_TABLE_INSERT_LOG, insert_log)
+
+        return output
+
+    def _write_log(self, log_path : str, log : Dict) -> None:
+
+        logger.info(f"logging {log} in {log_path}")
+
+        # write log to file
+        with open(log_path, mode="a+", encoding="utf-8") as f:
+            f.write(f"{log} \r\n")
+
+        return
+
+    def _health_table_insert(self, db : DatabaseQueries, record : Dict, insert_log : Dict) -> str:
 
         # check id component exists in id_register table
 
@@ -68,11 +115,7 @@ class HealthServiceClient(DatabaseQueries):
                 # update insert log
                 insert_log["successful"] = True
 
-                logger.info(f"Successfully inserted records, logging insert: {insert_log}")
-
-                # write log to file
-                with open(self.HEALTH_TABLE_INSERT_LOG, mode="a+", encoding="utf-8") as f:
-                    f.write(f"{insert_log} \r\n")
+                logger.info(f"Successfully inserted records")
 
                 output = "insert successful"
 
@@ -83,14 +126,6 @@ class HealthServiceClient(DatabaseQueries):
                 # update insert log
                 insert_log["successful"] = False
 
-                logger.info(
-                    f"logging unsuccessful insert: {insert_log} in {self.HEALTH_TABLE_INSERT_LOG}"
-                )
-
-                # write log to file
-                with open(self.HEALTH_TABLE_INSERT_LOG, mode="a+", encoding="utf-8") as f:
-                    f.write(f"{insert_log} \r\n")
-
                 output = "insert unsuccessful"
 
         else:
@@ -99,12 +134,6 @@ class HealthServiceClient(DatabaseQueries):
             # update insert log
             insert_log["successful"] = False
 
-            logger.info(
-                f"logging unsuccessful insert: {insert_log} in {self.HEALTH_TABLE_INSERT_LOG}"
-            )
-            # write log to file
-            with open(self.HEALTH_TABLE_INSERT_LOG, mode="a+", encoding="utf-8") as f:
-                f.write(f"{insert_log} \r\n")
             output = None
 
         return output
@@ -149,9 +178,30 @@ class HealthServiceClient(DatabaseQueries):
             return None
 
 
-        # initialise DB
+        with admitted(self.admission, self.DEPT_NAME, self.priority):
 
-        db = DatabaseQueries()
+            # the existence check and the update run as one unit of work,
+            # the log is only written once it has committed or failed
+            try:
+                if self.group_commit is not None:
+                    output = self.group_commit.run(lambda db: self._health_table_update(db, id_to_update, records_to_update, update_log))
+                else:
+                    # initialise DB
+                    db = DatabaseQueries()
+
+                    with db.transaction():
+                        output = self._health_table_update(db, id_to_update, records_to_update, update_log)
+            except Exception as e:
+                logger.info(f"Update was not committed: {e}")
+                update_log["successful"] = False
+                self._write_log(self.HEALTH_TABLE_UPDATE_LOG, update_log)
+                raise
+
+        self._write_log(self.HEALTH_TABLE_UPDATE_LOG, update_log)
+
+        return output
+
+    def _health_table_update(self, db : DatabaseQueries, id_to_update : int, records_to_update : Dict[str,Any], update_log : Dict) -> str:
 
         logger.info(f"Attempting to update the following records: {records_to_update}")
 
@@ -171,12 +221,6 @@ class HealthServiceClient(DatabaseQueries):
                 # update log
                 update_log["successful"] = True
 
-                logger.info(f"Logging update: {update_log} in {self.HEALTH_TABLE_UPDATE_LOG}")
-
-                # write log to file
-                with open(self.HEALTH_TABLE_UPDATE_LOG, mode="a+", encoding="utf-8") as f:
-                    f.write(f"{update_log} \r\n")
-
                 output = "update successfully completed"
 
             # if update is unsuccessful
@@ -185,12 +229,7 @@ class HealthServiceClient(DatabaseQueries):
                 # update log
                 update_log["successful"] = False
 
-                logger.info(
-                    f"Failed to update table, logging failed update: {update_log} in {self.HEALTH_TABLE_UPDATE_LOG}"
-                )
-
-                with open(self.HEALTH_TABLE_UPDATE_LOG, mode="a+", encoding="utf-8") as f:
-                    f.write(f"{update_log} \r\n")
+                logger.info(f"Failed to update table")
 
                 output = "update failed"
         else:
@@ -198,13 +237,6 @@ class HealthServiceClient(DatabaseQueries):
             logger.info(f"id: {id_to_update} does not exist in health_table")
             update_log["successful"] = False
 
-            logger.info(
-                f"Failed to update table, logging failed update: {update_log} in {self.HEALTH_TABLE_UPDATE_LOG}"
-            )
-
-            with open(self.HEALTH_TABLE_UPDATE_LOG, mode="a+", encoding="utf-8") as f:
-                f.write(f"{update_log} \r\n")
-
             output = "update failed"
 
         return output
@@ -212,15 +244,22 @@ class HealthServiceClient(DatabaseQueries):
 
     # TODO: eventually we want to put limits on the query e.g. only one column at a time.
 
-    def health_table_query(self, queried_by: str, password: str, attribute : str, id : int):
+    def health_table_query(self, queried_by: str, password: str, attribute : str, token : str):
 
-        db = DatabaseQueries()
+        """
+        Method for another department to query an attribute of the health table
+        Inputs: queried_by, password - department making the query and its password
+                attribute - column to return
+                token - the department's pseudonymous token for the id (see pseudonyms.py)
+        Output: dataframe of token and attribute, None if access is refused or the token is unknown
+        """
 
-        query = f"SELECT id, {attribute} FROM health_table WHERE id = {id};"
+        with admitted(self.admission, queried_by, self.priority):
+            return self._health_table_query(queried_by, password, attribute, token)
 
-        query_log = {"queried_by": queried_by,
-                     "query": query,
-                     "queried_at": datetime.datetime.now()}
+    def _health_table_query(self, queried_by: str, password: str, attribute : str, token : str):
+
+        db = DatabaseQueries()
 
         access_granted = db.health_dept_access_granted(queried_by, password)
 
@@ -230,6 +269,19 @@ class HealthServiceClient(DatabaseQueries):
             logger.info("access not granted to make this query")
             return None
 
+        id = db.resolve_id_token(queried_by, token)
+
+        if id is None:
+            logger.info(f"token is not known for {queried_by}")
+            return None
+
+        # return the token in place of the id so the querying department never sees the raw id
+        query = f"SELECT '{token}' AS token, {attribute} FROM health_table WHERE id = {id};"
+
+        query_log = {"queried_by": queried_by,
+                     "query": query,
+                     "queried_at": datetime.datetime.now()}
+
         try:
             query_output = db.query_health_table(query)
 
@@ -279,6 +331,9 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--password',
             dest='password',
             help='password of organisation requesting query')
+    parser.add_argument('-tok', '--token',
+            dest='token',
+            help='pseudonymous token of user, used by query')
     parser.add_argument('-att', '--attribute',
             dest='attribute',
             help='attribute queried')
@@ -305,6 +360,7 @@ if __name__ == "__main__":
     disability = args.disability
     queried_by = args.queried_by
     attribute = args.attribute
+    token = args.token
     password = args.password
     insert = args.insert
     update = args.update
@@ -319,4 +375,4 @@ if __name__ == "__main__":
         h.health_table_update(1, id, doctor, asthma, disability)
 
     if query:
-        print(h.health_table_query(queried_by, password, attribute, id))
+        print(h.health_table_query(queried_by, password, attribute, token))
@@ -0,0 +1,395 @@
+import os
+import hmac
+import yaml
+import json
+import hashlib
+import logging
+import argparse
+from typing import List, Dict, Any
+from database_operations import DatabaseQueries, is_valid_token
+
+
+logging.basicConfig(
+    format="%(name)s - %(asctime)s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("Pseudonyms")
+
+# Department keys are never kept in source. They are read from the YAML file named by the
+# DEPARTMENT_KEYS_FILE environment variable (department_keys.yaml by default, which git ignores),
+# see department_keys.example.yaml. Keys are held per department and per version so that a key
+# can be rotated while tokens issued under the old version are still being resolved:
+#   welfare_dept:
+#     current: 2
+#     keys:
+#       1: <old key>
+#       2: <new key>
+# The file is re-read whenever it changes, so rotating a key is an edit of the file, not of code.
+
+_loaded_keys = {'path': None, 'mtime': None, 'department_keys': None, 'current_key_versions': None}
+
+def load_department_keys(path : str = None) -> tuple:
+
+    '''
+    Method to read the department keys file, cached until the file changes
+    Output: (department_keys, current_key_versions)
+            e.g. ({'welfare_dept': {1: '...', 2: '...'}}, {'welfare_dept': 2})
+    '''
+
+    if path is None:
+        path = os.environ.get('DEPARTMENT_KEYS_FILE', 'department_keys.yaml')
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'department keys file {path} not found, set DEPARTMENT_KEYS_FILE '
+                                f'(see department_keys.example.yaml)')
+
+    mtime = os.stat(path).st_mtime_ns
+
+    if _loaded_keys['path'] != path or _loaded_keys['mtime'] != mtime:
+        with open(path, 'r') as f:
+            config = yaml.safe_load(f) or {}
+
+        department_keys = {}
+        current_key_versions = {}
+        for department, department_config in config.items():
+            department_keys[department] = {int(version): str(key) for version, key in department_config['keys'].items()}
+            current_key_versions[department] = int(department_config['current'])
+
+            if current_key_versions[department] not in department_keys[department]:
+                raise ValueError(f'current key version of {department} has no key in {path}')
+
+        _loaded_keys.update({'path': path, 'mtime': mtime,
+                             'department_keys': department_keys,
+                             'current_key_versions': current_key_versions})
+
+        logger.info(f"loaded keys for departments {list(department_keys)} from {path}")
+
+    return _loaded_keys['department_keys'], _loaded_keys['current_key_versions']
+
+
+class Pseudonymiser(DatabaseQueries):
+
+    PSEUDONYM_LOG = "logs/pseudonym_log.json"
+
+    BACKFILL_BATCH_SIZE = 10000
+
+    def __init__(self, keys_path : str = None):
+
+        '''
+        Inputs: keys_path - department keys file, defaults to $DEPARTMENT_KEYS_FILE or department_keys.yaml
+        '''
+
+        self.logger = logging.getLogger('Pseudonyms')
+        self.keys_path = keys_path
+        self.department_keys, self.current_key_versions = load_department_keys(keys_path)
+
+    # --------------
+    # Tokenisation
+    # --------------
+
+    # A department never sees the id_register id, only token = HMAC-SHA256(department key, id).
+    # Tokens are stored in id_tokens keyed on (department, token) so resolving is a single index lookup.
+
+    def _keyed_hmac(self, department : str, key_version : int):
+
+        key = self.department_keys[department][key_version]
+
+        return hmac.new(key.encode(), digestmod=hashlib.sha256)
+
+    def tokenise(self, department : str, id : int, key_version : int = None) -> str:
+
+        """
+        Method to compute the pseudonymous token for a single id
+        Inputs: department - department the token is for
+                id - id_register id
+                key_version - defaults to the department's current key version
+        """
+
+        if key_version is None:
+            key_version = self.current_key_versions[department]
+
+        return self.tokenise_batch(department, [id], key_version)[0]
+
+    def tokenise_batch(self, department : str, ids : List[int], key_version : int) -> List[str]:
+
+        """
+        Method to compute tokens for many ids at once
+        Note: the keyed HMAC state is built once and copied for each id, rather than
+              re-deriving the key padding for every id in the batch.
+        """
+
+        base = self._keyed_hmac(department, key_version)
+
+        tokens = []
+        for id in ids:
+            h = base.copy()
+            h.update(str(id).encode())
+            tokens.append(h.hexdigest())
+
+        return tokens
+
+    def token_rows(self, ids : List[int]) -> List[tuple]:
+
+        """
+        Method to build id_tokens rows for every department under its current key version
+        Output: list of (department, key_version, token, id) tuples
+        """
+
+        # long lived callers such as bulk ingest workers pick up a new current version here
+        self.department_keys, self.current_key_versions = load_department_keys(self.keys_path)
+
+        token_rows = []
+        for department, key_version in self.current_key_versions.items():
+            tokens = self.tokenise_batch(department, ids, key_version)
+            token_rows += [(department, key_version, token, id) for token, id in zip(tokens, ids)]
+
+        return token_rows
+
+    def issue_tokens(self, id : int, db : DatabaseQueries = None) -> Dict[str, str]:
+
+        """
+        Method to issue a token for every department under its current key version
+        Called at registration time, with the registration's db so the tokens are part of its transaction.
+        Output: {department: token}, to be handed to each department for its queries
+        """
+
+        if db is None:
+            db = DatabaseQueries()
+
+        token_rows = self.token_rows([id])
+
+        db.insert_id_tokens(token_rows)
+
+        logger.info(f"issued tokens for id to departments: {list(self.current_key_versions)}")
+
+        return {department: token for department, key_version, token, id in token_rows}
+
+    def resolve(self, department : str, token : str) -> int:
+
+        db = DatabaseQueries()
+
+        return db.resolve_id_token(department, token)
+
+    # --------------
+    # Backfill and key rotation
+    # --------------
+
+    # Rotation is done online in five steps:
+    # 1. add the new key to the keys file and run backfill with the new version (old tokens still resolve)
+    # 2. make it the current version in the keys file, running processes pick it up on their next Pseudonymiser
+    # 3. run backfill with the new version again, for ids registered by processes that had not yet been bumped
+    # 4. hand the department its new tokens: export_reissue writes old token -> new token for every id,
+    #    or the department swaps the tokens it holds a batch at a time with reissue()
+    # 5. run retire for the old version
+    # retire refuses to run while any id has no token of the current version, or any old token has not
+    # been reissued, so skipping step 3 or 4 cannot leave an id or a department without a working token.
+    # Each batch is committed on its own so the services are never blocked for the whole population.
+
+    def backfill(self, department : str, key_version : int = None, batch_size : int = None) -> int:
+
+        """
+        Method to tokenise every id in id_register for a department
+        Inputs: department, key_version (defaults to current), batch_size
+        Output: number of ids processed
+        Note: safe to rerun, already tokenised ids are skipped on insert.
+        """
+
+        if key_version is None:
+            key_version = self.current_key_versions[department]
+        if batch_size is None:
+            batch_size = self.BACKFILL_BATCH_SIZE
+
+        db = DatabaseQueries()
+
+        last_id = -1
+        processed = 0
+
+        while True:
+            ids = db.register_ids_after(last_id, batch_size)
+
+            if not ids:
+                break
+
+            tokens = self.tokenise_batch(department, ids, key_version)
+            db.insert_id_tokens([(department, key_version, token, id) for token, id in zip(tokens, ids)])
+
+            processed += len(ids)
+            last_id = ids[-1]
+
+            logger.info(f"backfilled {processed} ids for {department} key version {key_version}")
+
+        backfill_log = {"department": department,
+                        "key_version": key_version,
+                        "action": "backfill",
+                        "ids_processed": processed}
+
+        with open(self.PSEUDONYM_LOG, mode="a+", encoding="utf-8") as f:
+            f.write(f"{backfill_log} \r\n")
+
+        return processed
+
+    def reissue(self, department : str, tokens : List[str]) -> Dict[str, str]:
+
+        """
+        Method for a department to swap tokens it holds for tokens of the current key version
+        Inputs: department, tokens - a batch of the department's tokens of any version
+        Output: {old token: current token}, tokens already current map to themselves,
+                unknown or malformed tokens are left out
+        """
+
+        key_version = self.current_key_versions[department]
+        tokens = [token for token in tokens if is_valid_token(token)]
+
+        db = DatabaseQueries()
+
+        reissued = dict(db.reissue_tokens(department, key_version, tokens=tokens))
+
+        # the rest are either current already or unknown
+        for token in db.tokens_of_version(department, key_version, [token for token in tokens if token not in reissued]):
+            reissued[token] = token
+
+        return reissued
+
+    def export_reissue(self, department : str, key_version : int, path : str, batch_size : int = None) -> int:
+
+        """
+        Method to write the current version token for every token of an old key version, for the department
+        to replace the tokens it holds. Only tokens are written, never ids.
+        Inputs: department, key_version - the old version
+                path - file written with one {"old_token": ..., "new_token": ...} per line
+        Output: number of tokens written, None if some ids have no current version token yet
+        Note: safe to rerun, every old token is written each time.
+        """
+
+        if batch_size is None:
+            batch_size = self.BACKFILL_BATCH_SIZE
+
+        current_version = self.current_key_versions[department]
+
+        db = DatabaseQueries()
+
+        missing = db.count_ids_without_token(department, current_version)
+
+        if missing:
+            logger.info(f"{missing} ids have no key version {current_version} token for {department}, "
+                        f"run backfill with key version {current_version} before reissuing")
+            return None
+
+        last_id = -1
+        written = 0
+
+        with open(path, mode="w", encoding="utf-8") as f:
+            while True:
+                ids = db.token_ids_after(department, key_version, last_id, batch_size)
+
+                if not ids:
+                    break
+
+                for old_token, new_token in db.reissue_tokens(department, current_version, ids=ids):
+                    f.write(json.dumps({'old_token': old_token, 'new_token': new_token}) + '\n')
+                    written += 1
+
+                last_id = ids[-1]
+
+                logger.info(f"reissued {written} {department} tokens from key version {key_version} to {current_version}")
+
+        reissue_log = {"department": department,
+                       "key_version": key_version,
+                       "action": "reissue",
+                       "to_key_version": current_version,
+                       "tokens_reissued": written}
+
+        with open(self.PSEUDONYM_LOG, mode="a+", encoding="utf-8") as f:
+            f.write(f"{reissue_log} \r\n")
+
+        return written
+
+    def retire(self, department : str, key_version : int, batch_size : int = None) -> int:
+
+        """
+        Method to delete all tokens of an old key version, a batch at a time
+        Output: number of tokens deleted
+        """
+
+        if key_version == self.current_key_versions[department]:
+            logger.info(f"key version {key_version} is still current for {department}, not retiring")
+            return 0
+
+        if batch_size is None:
+            batch_size = self.BACKFILL_BATCH_SIZE
+
+        db = DatabaseQueries()
+
+        current_version = self.current_key_versions[department]
+        missing = db.count_ids_without_token(department, current_version)
+
+        if missing:
+            logger.info(f"{missing} ids have no key version {current_version} token for {department}, "
+                        f"run backfill with key version {current_version} before retiring")
+            return 0
+
+        not_reissued = db.count_tokens_not_reissued(department, key_version)
+
+        if not_reissued:
+            logger.info(f"{not_reissued} key version {key_version} tokens of {department} have not been reissued, "
+                        f"run the reissue export before retiring")
+            return 0
+
+        deleted = 0
+
+        while True:
+            n = db.delete_id_tokens(department, key_version, batch_size)
+            deleted += n
+
+            if n < batch_size:
+                break
+
+        retire_log = {"department": department,
+                      "key_version": key_version,
+                      "action": "retire",
+                      "tokens_deleted": deleted}
+
+        with open(self.PSEUDONYM_LOG, mode="a+", encoding="utf-8") as f:
+            f.write(f"{retire_log} \r\n")
+
+        return deleted
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dept', '--department',
+            dest='department',
+            help='department to tokenise ids for')
+    parser.add_argument('-v', '--key_version',
+            dest='key_version',
+            type=int,
+            default=None,
+            help='key version, defaults to the current version')
+    parser.add_argument('-b', '--backfill',
+            dest='backfill',
+            default=False,
+            help='Set to true to tokenise every registered id')
+    parser.add_argument('-r', '--retire',
+            dest='retire',
+            default=False,
+            help='Set to true to delete tokens of key_version')
+    parser.add_argument('-e', '--export_reissue',
+            dest='export_reissue',
+            default=None,
+            help='file to write the current token for every token of key_version to')
+
+    args = parser.parse_args()
+
+    p = Pseudonymiser()
+
+    if args.backfill:
+        p.backfill(args.department, args.key_version)
+
+    if args.export_reissue:
+        p.export_reissue(args.department, args.key_version, args.export_reissue)
+
+    if args.retire:
+        p.retire(args.department, args.key_version)
@@ -9,6 +9,9 @@ import datetime
 from jsonschema import validate
 from typing import List, Dict, Any
 from database_operations import DatabaseQueries
+from pseudonyms import Pseudonymiser
+from group_commit import GroupCommit
+from admission_control import AdmissionController, admitted
 
 
 logging.basicConfig(
@@ -23,9 +26,22 @@ class Registration(DatabaseQueries):
     REGISTRATION_RECORD_LOG = "logs/registration_record_log.json"
 
     SIZE_OF_ID_SPACE = 10000
+    DEPT_NAME = 'registration'
+
+    def __init__(self, group_commit : GroupCommit = None, admission : AdmissionController = None, priority : str = 'interactive'):
+
+        """
+        Inputs: group_commit - optional, if given record insertion is committed in groups
+                with other concurrent writes instead of one commit each (see group_commit.py)
+                admission - optional, if given every call waits for a slot before using the
+                database and may raise AdmissionRejected (see admission_control.py)
+                priority - 'interactive' or 'bulk', the admission priority of this client's calls
+        """
 
-    def __init__(self):
         self.logger = logging.getLogger('Registration')
+        self.group_commit = group_commit
+        self.admission = admission
+        self.priority = priority
 
     # --------------
     # Registration phase
@@ -39,18 +55,21 @@ class Registration(DatabaseQueries):
     # 1. generate_user_id
     # 2. registration_insert_record
     # 3. combine above two components into registration
+    # On insert each department is also issued a pseudonymous token for the id (see pseudonyms.py)
 
 
     def generate_user_id(self, name : str) -> int:
 
         record = {"name": name}
 
-        db = DatabaseQueries()
-
         id = randrange(self.SIZE_OF_ID_SPACE)
 
-        # check this ID is not already in use.
-        id_in_use = db.is_id_in_use(id)
+        with admitted(self.admission, self.DEPT_NAME, self.priority):
+
+            db = DatabaseQueries()
+
+            # check this ID is not already in use.
+            id_in_use = db.is_id_in_use(id)
 
         if id_in_use:
             logger.info(f"id is already in use, please rerun")
@@ -61,54 +80,83 @@ class Registration(DatabaseQueries):
         return output
 
 
-    def registration_insert_record(self, id: int, name : str) -> str:
+    def registration_insert_record(self, id: int, name : str) -> Dict[str, str]:
 
-        record = {"name": name}
+        """
+        Method to insert a record into id_register and issue the department tokens for it
+        Output: {department: token} to hand to each department, None if the id is already in use
+        """
+
+        registration_insert_log = {"name": name, "id": id, "logged_at": datetime.datetime.now()}
+
+        with admitted(self.admission, self.DEPT_NAME, self.priority):
+
+            # the in use check, the insert and issuing tokens run as one unit of work,
+            # the log is only written once it has committed or failed
+            try:
+                if self.group_commit is not None:
+                    tokens = self.group_commit.run(lambda db: self._registration_insert_record(db, id, name, registration_insert_log))
+                else:
+                    db = DatabaseQueries()
+
+                    with db.transaction():
+                        tokens = self._registration_insert_record(db, id, name, registration_insert_log)
+            except Exception as e:
+                logger.info(f"record insertion was not committed: {e}")
+                registration_insert_log["successful"] = False
+                raise
+            finally:
+                logger.info(f"logging record insertion attempt: {registration_insert_log}")
 
-        db = DatabaseQueries()
+                # write log to file
+                with open(self.REGISTRATION_RECORD_LOG, mode="a+", encoding="utf-8") as f:
+                    f.write(f"{registration_insert_log} \r\n")
+
+        # the tokens are returned, not logged, they are the only thing a department may hold for this user
+        return tokens
+
+    def _registration_insert_record(self, db : DatabaseQueries, id: int, name : str, registration_insert_log : Dict) -> Dict[str, str]:
+
+        tokens = None
+
+        record = {"name": name}
 
         id_in_use = db.is_id_in_use(id)
 
         record["id"] = id
-        registration_insert_log = record
-        registration_insert_log["logged_at"] = datetime.datetime.now()
-
+        record["logged_at"] = registration_insert_log["logged_at"]
 
         if id_in_use:
             logger.info(f"id is already in use")
             registration_insert_log["successful"] = False
-            logger.info(f"logging record insertion attempt: {registration_insert_log}")
-
-            # write log to file
-            with open(self.REGISTRATION_RECORD_LOG, mode="a+", encoding="utf-8") as f:
-                f.write(f"{registration_insert_log} \r\n")
         else:
             db.register_insert_record(record)
             logger.info(f"successfully inputted record into id_register table")
-            registration_insert_log["successful"] = True
 
-            logger.info(f"logging record insertion attempt: {registration_insert_log}")
+            # issue each department its pseudonymous token for this id
+            tokens = Pseudonymiser().issue_tokens(id, db)
 
-            # write log to file
-            with open(self.REGISTRATION_RECORD_LOG, mode="a+", encoding="utf-8") as f:
-                f.write(f"{registration_insert_log} \r\n")
-        return
+            registration_insert_log["successful"] = True
 
+        return tokens
 
-    def registration(self, name : str) -> str:
+
+    def registration(self, name : str) -> Dict[str, str]:
 
         logger.info(f"generating user id")
 
         id = self.generate_user_id(name)
 
+        tokens = None
+
         if id is not None:
             logger.info(f"inserting record into database")
-            self.registration_insert_record(id, name)
+            tokens = self.registration_insert_record(id, name)
             logger.info(f"successfully registered name: {name} with id: {id}")
         else:
             logger.info(f"no id present (id is None)")
 
-        return
+        return tokens
 
 
 
@@ -134,11 +182,11 @@ if __name__ == "__main__":
 
     if not test:
         r = Registration()
-        r.registration(name)
+        print(r.registration(name))
 
     else:
         r = Registration()
-        r.registration_insert_record(id, name)
+        print(r.registration_insert_record(id, name))
     # We will now walk through the functionalities of the system by populating the db_tables
     # The commands are currenttly commented, I recommed as you go down the page you recomment them so only the part of interest is being run.
 
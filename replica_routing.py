@@ -0,0 +1,236 @@
+import time
+import records
+import logging
+import threading
+from typing import List, Dict, Any, Callable
+
+
+logging.basicConfig(
+    format="%(name)s - %(asctime)s - %(message)s",
+    datefmt="%d-%b-%y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger("Replica Routing")
+
+# replay lag of a replica in seconds. A replica that is streaming from the primary and has replayed
+# everything it has received is not lagging however long ago the last write was. A replica whose
+# WAL receiver is not streaming cannot tell how far behind it is, so its lag is NULL, which is
+# treated as infinite. A server that is not in recovery is not a replica and has no lag.
+REPLICA_LAG_QUERY = '''
+SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+       END AS lag_seconds;
+'''
+
+
+class ReplicaRouter(object):
+
+    # --------------
+    # Read routing
+    # --------------
+
+    # One router is shared by every DatabaseQueries in the process with the same replicas (see shared()).
+    # Reads are spread round robin over the replicas that passed their last health check and whose
+    # lag is within max_lag_seconds. A background thread checks every replica every HEALTH_CHECK_SECONDS,
+    # so reads never wait on a health check. A replica is marked unhealthy straight away if a read on
+    # it fails, the read then moves on to the next replica and finally to the primary. Until a replica
+    # has been checked once it gets no reads.
+    # A thread that has just written reads from the primary for read_your_writes_seconds, so it
+    # always sees its own writes. Writes made on another thread for the caller (see GroupCommit.run)
+    # have to be recorded on the caller's thread with record_write().
+
+    HEALTH_CHECK_SECONDS = 5
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, replica_urls : List[str], max_lag_seconds : float, read_your_writes_seconds : float,
+                 health_check_thread : bool = True):
+
+        '''
+        Inputs: replica_urls - records urls of the replicas
+                max_lag_seconds - replicas lagging more than this get no reads
+                read_your_writes_seconds - how long a thread reads from the primary after writing
+                health_check_thread - False to leave health checks to the caller, see check_replicas()
+        '''
+
+        self.logger = logging.getLogger('Replica Routing')
+        self.max_lag_seconds = max_lag_seconds
+        self.read_your_writes_seconds = read_your_writes_seconds
+
+        self.replicas = [{'url': url, 'db': None, 'healthy': False, 'lag_seconds': None,
+                          'checked_at': None, 'failed_at': None}
+                         for url in replica_urls]
+
+        # guards replicas, next_replica and reads, held only while reading or updating them
+        self.lock = threading.Lock()
+        self.next_replica = 0
+        self.local = threading.local()
+
+        self.reads = {'primary': 0}
+        for url in replica_urls:
+            self.reads[url] = 0
+
+        self.stopped = threading.Event()
+        self.health_check_thread = None
+        if health_check_thread:
+            self.health_check_thread = threading.Thread(target=self._health_check_loop, name='replica-health-check', daemon=True)
+            self.health_check_thread.start()
+
+    @classmethod
+    def shared(cls, replica_urls : List[str], max_lag_seconds : float, read_your_writes_seconds : float):
+
+        """
+        Method to get the process wide router for a set of replicas, creating it on first use
+        """
+
+        key = (tuple(replica_urls), max_lag_seconds, read_your_writes_seconds)
+
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(replica_urls, max_lag_seconds, read_your_writes_seconds)
+
+            return cls._shared[key]
+
+    def record_write(self) -> None:
+
+        self.local.last_write_at = time.monotonic()
+
+        return
+
+    def _pinned_to_primary(self) -> bool:
+
+        last_write_at = getattr(self.local, 'last_write_at', None)
+
+        return last_write_at is not None and time.monotonic() - last_write_at < self.read_your_writes_seconds
+
+    def _mark_unhealthy(self, replica : Dict[str, Any], error : Exception) -> None:
+
+        logger.info(f"replica {replica['url'].split('@')[-1]} unhealthy: {error}")
+
+        with self.lock:
+            replica['healthy'] = False
+            replica['db'] = None
+            replica['failed_at'] = time.monotonic()
+
+        return
+
+    def _check(self, replica : Dict[str, Any]) -> None:
+
+        started = time.monotonic()
+
+        with self.lock:
+            db = replica['db']
+
+        # the query runs without the lock, reads carry on while a replica is being checked
+        try:
+            if db is None:
+                db = records.Database(replica['url'])
+
+            lag = db.query(REPLICA_LAG_QUERY, fetchall=True).export('df')['lag_seconds'].to_list()[0]
+
+        except Exception as e:
+            self._mark_unhealthy(replica, e)
+            return
+
+        with self.lock:
+            # a read that failed while we were checking knows better than this check
+            if replica['failed_at'] is not None and replica['failed_at'] > started:
+                return
+
+            replica['db'] = db
+            replica['lag_seconds'] = float('inf') if lag is None or lag != lag else float(lag)
+            replica['healthy'] = True
+            replica['checked_at'] = started
+
+        return
+
+    def check_replicas(self) -> None:
+
+        """
+        Method to check the health and lag of every replica, run every HEALTH_CHECK_SECONDS by the health check thread
+        """
+
+        for replica in self.replicas:
+            self._check(replica)
+
+        return
+
+    def _health_check_loop(self) -> None:
+
+        while True:
+            self.check_replicas()
+
+            if self.stopped.wait(self.HEALTH_CHECK_SECONDS):
+                return
+
+    def stop(self) -> None:
+
+        """
+        Method to stop the health check thread
+        """
+
+        self.stopped.set()
+
+        if self.health_check_thread is not None:
+            self.health_check_thread.join()
+
+        return
+
+    def _candidates(self) -> List[Dict[str, Any]]:
+
+        with self.lock:
+            candidates = [replica for replica in self.replicas
+                          if replica['healthy'] and replica['lag_seconds'] <= self.max_lag_seconds]
+
+            if not candidates:
+                return candidates
+
+            # rotate so each read starts at the next usable replica, the rest are failover order
+            start = self.next_replica % len(candidates)
+            self.next_replica += 1
+
+            return [(replica, replica['db']) for replica in candidates[start:] + candidates[:start]]
+
+    def read(self, query : str, primary_query : Callable[[str], Any]):
+
+        """
+        Method to run a read on a replica, or on the primary when none can serve it
+        Inputs: query - a SELECT statement
+                primary_query - function running a query on the primary
+        """
+
+        if not self._pinned_to_primary():
+            for replica, db in self._candidates():
+                try:
+                    result = db.query(query, fetchall=True)
+                except Exception as e:
+                    self._mark_unhealthy(replica, e)
+                    continue
+
+                with self.lock:
+                    self.reads[replica['url']] += 1
+
+                return result
+
+        with self.lock:
+            self.reads['primary'] += 1
+
+        return primary_query(query)
+
+    def status(self) -> Dict[str, Any]:
+
+        """
+        Method to get the health and lag of each replica and the number of reads sent to each endpoint
+        """
+
+        with self.lock:
+            replicas = [{'endpoint': replica['url'].split('@')[-1],
+                         'healthy': replica['healthy'],
+                         'lag_seconds': replica['lag_seconds']} for replica in self.replicas]
+
+            reads = {url.split('@')[-1]: n for url, n in self.reads.items()}
+
+        return {'replicas': replicas, 'reads': reads}
@@ -0,0 +1,29 @@
+import os
+import sys
+import types
+import importlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _not_installed(*args, **kwargs):
+    raise RuntimeError('database driver not installed, tests replace every database call with a fake')
+
+
+# The services import the database drivers at module level. Where they are not installed, stand-ins
+# let the modules import, every test then replaces the database layer itself.
+for name, attributes in [('records', ['Database']),
+                         ('psycopg2', ['connect', 'OperationalError']),
+                         ('psycopg2.extras', ['execute_values', 'Json', 'DictCursor']),
+                         ('jsonschema', ['validate']),
+                         ('jsonschema.validators', ['validator_for'])]:
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        for attribute in attributes:
+            setattr(module, attribute, Exception if attribute == 'OperationalError' else _not_installed)
+        sys.modules[name] = module
+        if '.' in name:
+            parent, child = name.rsplit('.', 1)
+            setattr(sys.modules[parent], child, module)
@@ -0,0 +1,227 @@
+import time
+import threading
+import pytest
+
+import admission_control
+from admission_control import AdmissionController, AdmissionRejected, acquire_bulk_slot
+
+
+def start_waiter(admission, department, priority, admitted_order, hold=None):
+
+    '''
+    Acquires a slot on a thread and records the department once admitted
+    If hold is given the slot is kept until it is set, otherwise released straight away
+    '''
+
+    errors = []
+
+    def run():
+        try:
+            admission.acquire(department, priority)
+        except AdmissionRejected as e:
+            errors.append(e)
+            return
+
+        admitted_order.append(department)
+
+        if hold is not None:
+            hold.wait(5)
+
+        admission.release(department)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    return thread, errors
+
+
+def wait_for_queue(admission, depth):
+
+    deadline = time.monotonic() + 5
+    while sum(admission.metrics()['queue_depth'].values()) < depth:
+        assert time.monotonic() < deadline, 'waiters never queued'
+        time.sleep(0.005)
+
+
+def test_waiters_are_admitted_interactive_first_then_in_arrival_order():
+
+    admission = AdmissionController(max_concurrent=1, queue_timeout_seconds=5)
+    admission.acquire('health_dept', 'interactive')
+
+    admitted_order = []
+    threads = []
+
+    for department, priority in [('bulk_1', 'bulk'), ('interactive_1', 'interactive'),
+                                 ('bulk_2', 'bulk'), ('interactive_2', 'interactive')]:
+        thread, errors = start_waiter(admission, department, priority, admitted_order)
+        threads.append(thread)
+        wait_for_queue(admission, len(threads))
+
+    assert admission.metrics()['queue_depth'] == {'interactive': 2, 'bulk': 2}
+
+    admission.release('health_dept')
+
+    for thread in threads:
+        thread.join(5)
+
+    assert admitted_order == ['interactive_1', 'interactive_2', 'bulk_1', 'bulk_2']
+
+
+def test_department_at_its_limit_is_skipped_not_blocking():
+
+    admission = AdmissionController(max_concurrent=3, queue_timeout_seconds=5,
+                                    department_limits={'welfare_dept': {'max_concurrent': 1}})
+    admission.acquire('welfare_dept')
+
+    admitted_order = []
+    hold = threading.Event()
+
+    welfare, welfare_errors = start_waiter(admission, 'welfare_dept', 'interactive', admitted_order, hold)
+    wait_for_queue(admission, 1)
+
+    # health_dept arrives later but is admitted while welfare_dept waits on its own limit
+    health, health_errors = start_waiter(admission, 'health_dept', 'interactive', admitted_order, hold)
+
+    deadline = time.monotonic() + 5
+    while admitted_order != ['health_dept']:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+    metrics = admission.metrics()
+    assert metrics['in_flight_by_department'] == {'welfare_dept': 1, 'health_dept': 1}
+    assert metrics['queue_depth']['interactive'] == 1
+
+    admission.release('welfare_dept')
+
+    deadline = time.monotonic() + 5
+    while admitted_order != ['health_dept', 'welfare_dept']:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+    hold.set()
+    welfare.join(5)
+    health.join(5)
+
+    assert not welfare_errors and not health_errors
+    assert admission.metrics()['in_flight'] == 0
+
+
+def test_department_over_its_rate_is_rejected():
+
+    admission = AdmissionController(department_limits={'welfare_dept': {'rate': 0.001, 'burst': 2}})
+
+    for _ in range(2):
+        with admission.admit('welfare_dept'):
+            pass
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.acquire('welfare_dept')
+
+    assert rejected.value.status == 'rate_limited'
+    assert rejected.value.department == 'welfare_dept'
+
+    # other departments have no bucket
+    with admission.admit('health_dept'):
+        pass
+
+    metrics = admission.metrics()
+    assert metrics['rejected']['rate_limited'] == 1
+    assert metrics['admitted']['interactive'] == 3
+
+
+def test_full_queue_is_rejected_per_priority():
+
+    admission = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout_seconds=5)
+    admission.acquire('health_dept')
+
+    admitted_order = []
+    waiter, errors = start_waiter(admission, 'bulk_1', 'bulk', admitted_order)
+    wait_for_queue(admission, 1)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.acquire('bulk_2', 'bulk')
+
+    assert rejected.value.status == 'queue_full'
+    assert rejected.value.priority == 'bulk'
+
+    # the interactive queue is separate
+    interactive, interactive_errors = start_waiter(admission, 'interactive_1', 'interactive', admitted_order)
+    wait_for_queue(admission, 2)
+
+    admission.release('health_dept')
+    waiter.join(5)
+    interactive.join(5)
+
+    assert not errors and not interactive_errors
+    assert admitted_order == ['interactive_1', 'bulk_1']
+    assert admission.metrics()['rejected']['queue_full'] == 1
+
+
+def test_wait_longer_than_timeout_is_rejected():
+
+    admission = AdmissionController(max_concurrent=1, queue_timeout_seconds=0.05)
+    admission.acquire('health_dept')
+
+    started = time.monotonic()
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.acquire('welfare_dept', 'bulk')
+
+    assert rejected.value.status == 'timeout'
+    assert time.monotonic() - started >= 0.05
+
+    metrics = admission.metrics()
+    assert metrics['rejected']['timeout'] == 1
+    assert metrics['queue_depth'] == {'interactive': 0, 'bulk': 0}
+    assert metrics['in_flight'] == 1
+
+
+def test_admit_releases_on_error():
+
+    admission = AdmissionController(max_concurrent=1)
+
+    with pytest.raises(RuntimeError):
+        with admission.admit('health_dept'):
+            raise RuntimeError('query failed')
+
+    assert admission.metrics()['in_flight'] == 0
+    assert admission.metrics()['in_flight_by_department'] == {'health_dept': 0}
+
+
+def test_unknown_priority_is_refused():
+
+    with pytest.raises(ValueError):
+        AdmissionController().acquire('health_dept', 'urgent')
+
+
+class FakeLocks(object):
+
+    def __init__(self, held):
+        self.held = set(held)
+        self.tried = []
+
+    def try_advisory_xact_lock(self, lock_class, key):
+        self.tried.append((lock_class, key))
+        if key in self.held:
+            return False
+        self.held.add(key)
+        return True
+
+
+def test_bulk_slot_takes_first_free_slot():
+
+    db = FakeLocks(held=[0])
+
+    assert acquire_bulk_slot(db, 2, timeout_seconds=1) == 1
+    assert db.tried == [(admission_control.BULK_SLOT_LOCK_CLASS, 0), (admission_control.BULK_SLOT_LOCK_CLASS, 1)]
+
+
+def test_bulk_slot_wait_is_bounded():
+
+    db = FakeLocks(held=[0, 1])
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        acquire_bulk_slot(db, 2, timeout_seconds=0.05, poll_seconds=0.01)
+
+    assert rejected.value.status == 'timeout'
+    assert rejected.value.priority == 'bulk'
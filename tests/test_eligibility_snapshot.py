@@ -0,0 +1,204 @@
+import json
+import hmac
+import hashlib
+import pandas as pd
+import pytest
+
+import eligibility_snapshot
+import welfare_servce
+from eligibility_snapshot import EligibilitySnapshotBuilder, EligibilitySnapshot
+
+
+def token_for(id):
+    return hmac.new(b'test-key', str(id).encode(), hashlib.sha256).hexdigest()
+
+
+class FakeDatabase(object):
+
+    '''
+    Stands in for DatabaseQueries: health_table and id_tokens are dataframes,
+    holds and change_log are dicts of what the real tables would hold
+    '''
+
+    health_rows = None
+    token_rows = None
+    holds = {}
+    changed = []
+    xmin = 100
+
+    def health_dept_access_granted(self, department, password):
+        return password == 'welfare'
+
+    def health_eligibility_rows(self):
+        return FakeDatabase.health_rows
+
+    def department_tokens(self, department):
+        return FakeDatabase.token_rows
+
+    def hold_change_log(self, consumer):
+        FakeDatabase.holds[consumer] = FakeDatabase.xmin
+        return FakeDatabase.xmin
+
+    def change_log_hold(self, consumer):
+        return FakeDatabase.holds.get(consumer)
+
+    def changed_row_ids(self, table_name, since_txid):
+        return list(FakeDatabase.changed)
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+
+    FakeDatabase.health_rows = pd.DataFrame({'id': [1, 3, 5, 9],
+                                             'has_asthma': [True, None, False, True],
+                                             'has_registered_disability': [False, True, None, True]})
+    FakeDatabase.token_rows = pd.DataFrame({'token': [token_for(id) for id in (1, 3, 5, 7, 9)] + ['not-a-token'],
+                                            'id': [1, 3, 5, 7, 9, 11]})
+    FakeDatabase.holds = {}
+    FakeDatabase.changed = []
+    FakeDatabase.xmin = 100
+
+    monkeypatch.setattr(eligibility_snapshot, 'DatabaseQueries', FakeDatabase)
+    monkeypatch.setattr(welfare_servce, 'DatabaseQueries', FakeDatabase)
+    monkeypatch.setattr(EligibilitySnapshotBuilder, 'SNAPSHOT_LOG', str(tmp_path / 'snapshot_log.json'))
+
+    return FakeDatabase
+
+
+@pytest.fixture
+def path(database, tmp_path):
+
+    path = str(tmp_path / 'welfare.snap')
+    EligibilitySnapshotBuilder().build(path, 'welfare_dept', 'welfare')
+
+    return path
+
+
+def test_build_needs_access(database, tmp_path):
+
+    assert EligibilitySnapshotBuilder().build(str(tmp_path / 'x.snap'), 'welfare_dept', 'wrong') is None
+
+
+def test_lookup_reads_attribute_bits(path):
+
+    snapshot = EligibilitySnapshot(path)
+
+    result = snapshot.lookup('has_asthma', [1, 3, 5, 9, 2, 7])
+
+    # NULL is stored as False, ids without a health row are not present
+    assert result['present'].tolist() == [True, True, True, True, False, False]
+    assert result['value'].tolist() == [True, False, False, True, False, False]
+
+    result = snapshot.lookup('has_registered_disability', [1, 3, 5, 9])
+    assert result['value'].tolist() == [False, True, False, True]
+
+
+def test_lookup_outside_id_space_is_not_present(path):
+
+    result = EligibilitySnapshot(path).lookup('has_asthma', [-1, 10, 1000000])
+
+    assert result['present'].tolist() == [False, False, False]
+    assert result['value'].tolist() == [False, False, False]
+
+
+def test_resolve_tokens(path):
+
+    snapshot = EligibilitySnapshot(path)
+
+    same_prefix = token_for(3)[:16] + '0' * 48
+
+    resolved = snapshot.resolve_tokens([token_for(5), token_for(1), token_for(2), same_prefix,
+                                        'not-a-token', token_for(9).upper(), None])
+
+    assert resolved.tolist() == [5, 1, -1, -1, -1, -1, -1]
+    assert snapshot.resolve_tokens([]).tolist() == []
+
+
+def test_empty_tables_build_an_empty_snapshot(database, tmp_path):
+
+    # records exports an empty result as a dataframe with no columns
+    database.health_rows = pd.DataFrame()
+    database.token_rows = pd.DataFrame()
+
+    path = str(tmp_path / 'empty.snap')
+    header = EligibilitySnapshotBuilder().build(path, 'welfare_dept', 'welfare')
+
+    assert header['id_space'] == 0
+
+    snapshot = EligibilitySnapshot(path)
+    assert snapshot.lookup('has_asthma', [0, 1])['present'].tolist() == [False, False]
+    assert snapshot.resolve_tokens([token_for(1)]).tolist() == [-1]
+
+
+def test_rebuild_supersedes_open_snapshot(database, path):
+
+    snapshot = EligibilitySnapshot(path)
+    assert snapshot.header['version'] == 1
+
+    snapshot.changed_ids(database())
+    assert not snapshot.is_stale()
+
+    database.xmin = 200
+    header = EligibilitySnapshotBuilder().build(path, 'welfare_dept', 'welfare')
+    assert header['version'] == 2
+
+    snapshot._changed_ids_read_at = None
+    snapshot.changed_ids(database())
+    assert snapshot.is_stale()
+
+
+def test_rebuild_over_older_format_continues_version(database, tmp_path):
+
+    path = tmp_path / 'old.snap'
+    path.write_bytes(json.dumps({'magic': 'IDSNAP', 'format': 1, 'version': 6}).encode().ljust(eligibility_snapshot.HEADER_SIZE))
+
+    assert EligibilitySnapshotBuilder().build(str(path), 'welfare_dept', 'welfare')['version'] == 7
+
+
+class FakeHealthServiceClient(object):
+
+    queried = []
+
+    def __init__(self, admission=None, priority='interactive'):
+        pass
+
+    def health_table_query(self, queried_by, password, attribute, token):
+        FakeHealthServiceClient.queried.append(token)
+        return pd.DataFrame({'token': [token], attribute: [True]})
+
+
+@pytest.fixture
+def welfare(monkeypatch, path, tmp_path):
+
+    FakeHealthServiceClient.queried = []
+    monkeypatch.setattr(welfare_servce, 'HealthServiceClient', FakeHealthServiceClient)
+    monkeypatch.setattr(welfare_servce.WelfareServiceClient, 'WELFARE_QUERY_LOG', str(tmp_path / 'query_log.json'))
+
+    return welfare_servce.WelfareServiceClient(path)
+
+
+def test_batch_answers_from_snapshot_and_falls_back(welfare, database):
+
+    database.changed = [9]
+
+    # 1 and 3 are answered by the snapshot, 7 has a token but no health row, 9 changed since
+    # the snapshot, 2 is not in the snapshot and the last is not a token at all
+    tokens = [token_for(1), token_for(3), token_for(7), token_for(9), token_for(2), 'bad']
+
+    result = welfare.welfare_disability_authenticate_batch(tokens)
+
+    assert FakeHealthServiceClient.queried == [token_for(9), token_for(2), 'bad']
+
+    answered = dict(zip(result['token'], result['has_registered_disability']))
+    assert answered[token_for(1)] == False
+    assert answered[token_for(3)] == True
+    assert token_for(7) not in answered
+
+
+def test_batch_falls_back_entirely_once_superseded(welfare, database):
+
+    database.holds.clear()
+
+    welfare.welfare_disability_authenticate_batch([token_for(1), token_for(3)])
+
+    assert FakeHealthServiceClient.queried == [token_for(1), token_for(3)]
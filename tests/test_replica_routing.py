@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import types
+import threading
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the router only needs records.Database, which every test replaces with a fake
+try:
+    import records
+except ImportError:
+    sys.modules['records'] = types.ModuleType('records')
+
+import replica_routing
+from replica_routing import ReplicaRouter
+
+
+class FakeResult(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def export(self, format):
+        return pd.DataFrame(self.rows)
+
+
+class FakeDatabase(object):
+
+    '''
+    Stands in for a records.Database: answers the lag query with its lag and
+    any other query with its own name, or raises if it is down
+    '''
+
+    def __init__(self, name, lag=0.0):
+        self.name = name
+        self.lag = lag
+        self.down = False
+
+    def query(self, query, fetchall=False):
+        if self.down:
+            raise Exception(f'{self.name} is down')
+        if query == replica_routing.REPLICA_LAG_QUERY:
+            return FakeResult([{'lag_seconds': self.lag}])
+        return self.name
+
+
+@pytest.fixture
+def servers(monkeypatch):
+
+    servers = {'postgres://u:p@replica1/d': FakeDatabase('replica1'),
+               'postgres://u:p@replica2/d': FakeDatabase('replica2')}
+
+    monkeypatch.setattr(replica_routing, 'records', types.SimpleNamespace(Database=lambda url: servers[url]), raising=False)
+
+    return servers
+
+
+@pytest.fixture
+def router(servers):
+
+    router = ReplicaRouter(list(servers), max_lag_seconds=5, read_your_writes_seconds=0.2, health_check_thread=False)
+    router.check_replicas()
+
+    return router
+
+
+def read(router, primary=FakeDatabase('primary')):
+    return router.read('SELECT 1;', primary.query)
+
+
+def test_reads_are_spread_round_robin(router):
+
+    assert [read(router) for _ in range(4)] == ['replica1', 'replica2', 'replica1', 'replica2']
+    assert router.status()['reads'] == {'primary': 0, 'replica1/d': 2, 'replica2/d': 2}
+
+
+def test_unchecked_replicas_get_no_reads(servers):
+
+    router = ReplicaRouter(list(servers), max_lag_seconds=5, read_your_writes_seconds=0.2, health_check_thread=False)
+
+    assert read(router) == 'primary'
+
+
+def test_read_error_fails_over_to_next_replica_then_primary(router, servers):
+
+    servers['postgres://u:p@replica1/d'].down = True
+
+    assert [read(router) for _ in range(3)] == ['replica2', 'replica2', 'replica2']
+    assert [replica['healthy'] for replica in router.status()['replicas']] == [False, True]
+
+    servers['postgres://u:p@replica2/d'].down = True
+
+    assert read(router) == 'primary'
+
+
+def test_failed_replica_comes_back_after_health_check(router, servers):
+
+    servers['postgres://u:p@replica1/d'].down = True
+    read(router)
+
+    servers['postgres://u:p@replica1/d'].down = False
+    router.check_replicas()
+
+    assert sorted(read(router) for _ in range(2)) == ['replica1', 'replica2']
+
+
+def test_lag_above_threshold_goes_to_primary(router, servers):
+
+    servers['postgres://u:p@replica1/d'].lag = 10
+    router.check_replicas()
+
+    assert [read(router) for _ in range(2)] == ['replica2', 'replica2']
+
+    # a replica whose WAL receiver is not streaming reports NULL lag, which counts as infinite
+    servers['postgres://u:p@replica2/d'].lag = None
+    router.check_replicas()
+
+    assert read(router) == 'primary'
+    assert router.status()['replicas'][1]['lag_seconds'] == float('inf')
+
+
+def test_thread_is_pinned_to_primary_after_a_write(router):
+
+    router.record_write()
+
+    assert read(router) == 'primary'
+
+    # other threads have not written and still read from the replicas
+    other = []
+    t = threading.Thread(target=lambda: other.append(read(router)))
+    t.start()
+    t.join()
+    assert other == ['replica1']
+
+    time.sleep(0.25)
+
+    assert read(router) == 'replica2'
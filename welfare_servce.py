@@ -6,10 +6,14 @@ import logging
 import argparse
 import ast
 import datetime
+import numpy as np
+import pandas as pd
 from jsonschema import validate
 from typing import List, Dict, Any
 from database_operations import DatabaseQueries
 from health_service import HealthServiceClient
+from eligibility_snapshot import EligibilitySnapshot
+from admission_control import AdmissionController, admitted
 
 
 logging.basicConfig(
@@ -26,26 +30,42 @@ class WelfareServiceClient(DatabaseQueries):
     DEPT_NAME = 'welfare_dept'
     PASSWORD = 'welfare'
 
-    def __init__(self):
+    def __init__(self, snapshot_path : str = None, admission : AdmissionController = None):
+
+        '''
+        Inputs: snapshot_path - optional eligibility snapshot (see eligibility_snapshot.py).
+                If given, lookups are answered from the snapshot and only go to the
+                health dept for tokens it cannot answer.
+                admission - optional, if given database lookups wait for a slot, single checks as
+                interactive and batch checks as bulk (see admission_control.py)
+        '''
+
         self.logger = logging.getLogger('Welfare Service')
 
-    def welfare_disability_authenticate(self, id):
+        self.snapshot = EligibilitySnapshot(snapshot_path) if snapshot_path else None
+        self.snapshot_db = None
+        self.admission = admission
+
+    def welfare_disability_authenticate(self, token):
 
         '''
         Method for check if a user is  registered as having a disability
-        Inputs: user id
+        Inputs: the welfare dept's pseudonymous token for the user
         Outputs: has_registered_disability value
         '''
 
+        if self.snapshot is not None:
+            return self.welfare_disability_authenticate_batch([token], priority='interactive')
+
         attribute = 'has_registered_disability'
 
-        hc = HealthServiceClient()
+        hc = HealthServiceClient(admission=self.admission, priority='interactive')
 
-        query_output = hc.health_table_query(self.DEPT_NAME, self.PASSWORD, attribute, id)
+        query_output = hc.health_table_query(self.DEPT_NAME, self.PASSWORD, attribute, token)
 
         query_log = {'querier': self.DEPT_NAME,
                      'dept_queried': 'health  dept',
-                     'id_queried': id,
+                     'token_queried': token,
                      'atttribute_queried': attribute,
                      'query_time': datetime.datetime.now()}
 
@@ -57,18 +77,88 @@ class WelfareServiceClient(DatabaseQueries):
 
         return query_output
 
+    def welfare_disability_authenticate_batch(self, tokens : List[str], priority : str = 'bulk'):
+
+        '''
+        Method for checking many users at once, answered from the snapshot where possible
+        Inputs: list of the welfare dept's pseudonymous tokens
+                priority - admission priority of the database lookups
+        Outputs: dataframe of token and has_registered_disability, one row per token with a health record
+        Note: a token goes to the health dept instead if the snapshot is stale or replaced, does not know
+              the token, or the id has been written since the snapshot was taken.
+        '''
+
+        attribute = 'has_registered_disability'
+
+        answered = []
+        fallback = []
+
+        use_snapshot = self.snapshot is not None and not self.snapshot.is_stale()
+
+        if use_snapshot:
+            if self.snapshot_db is None:
+                self.snapshot_db = DatabaseQueries()
+
+            with admitted(self.admission, self.DEPT_NAME, priority):
+                changed_ids = self.snapshot.changed_ids(self.snapshot_db)
+
+            # reading the changed ids also finds out whether the snapshot has been superseded
+            use_snapshot = not self.snapshot.is_stale()
+
+        if not use_snapshot:
+            fallback = list(tokens)
+        else:
+            ids = self.snapshot.resolve_tokens(tokens)
+            result = self.snapshot.lookup(attribute, ids)
+
+            answerable = (ids >= 0) & ~np.isin(ids, changed_ids)
+
+            for token, use, present, value in zip(tokens, answerable, result['present'], result['value']):
+                if not use:
+                    fallback.append(token)
+                elif present:
+                    answered.append((token, bool(value)))
+
+        query_outputs = [pd.DataFrame(answered, columns=['token', attribute])]
+
+        hc = HealthServiceClient(admission=self.admission, priority=priority)
+
+        for token in fallback:
+            query_output = hc.health_table_query(self.DEPT_NAME, self.PASSWORD, attribute, token)
+            if query_output is not None:
+                query_outputs.append(query_output)
+
+        query_log = {'querier': self.DEPT_NAME,
+                     'dept_queried': 'health  dept',
+                     'tokens_queried': len(tokens),
+                     'answered_from_snapshot': len(tokens) - len(fallback),
+                     'snapshot_version': self.snapshot.header['version'] if self.snapshot is not None else None,
+                     'atttribute_queried': attribute,
+                     'query_time': datetime.datetime.now()}
+
+        logger.info(f'Successfully made batch query. Writing query details to {self.WELFARE_QUERY_LOG}')
+
+        # write log to file
+        with open(self.WELFARE_QUERY_LOG, mode="a+", encoding="utf-8") as f:
+            f.write(f"{query_log} \r\n")
+
+        return pd.concat(query_outputs, ignore_index=True)
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-id', '--id',
-            dest='id',
-            type=int,
-            help='ID of user')
+    parser.add_argument('-tok', '--token',
+            dest='token',
+            help='pseudonymous token of user')
+    parser.add_argument('-s', '--snapshot',
+            dest='snapshot',
+            default=None,
+            help='path of eligibility snapshot to answer from')
 
     args = parser.parse_args()
 
-    id = args.id
+    token = args.token
 
-    wc = WelfareServiceClient()
+    wc = WelfareServiceClient(args.snapshot)
 
-    print(wc.welfare_disability_authenticate(id))
+    print(wc.welfare_disability_authenticate(token))